@@ -37,6 +37,7 @@ class AST(UserList):
 
 class ParserError(Exception):
     def __init__(self, token, offset):
+        Exception.__init__(self, token, offset) # for pickling
         self.token = token
         self.offset = offset
 
@@ -725,6 +726,15 @@ nop = lambda self, args: None
 
 p = Parser()
 
+def reset():
+    """
+    Replace p by a new parser.  A parse interrupted half way (see
+    Walker.within_budget()) can leave p with a rule marked as added
+    but missing, or with half-built states.
+    """
+    global p
+    p = Parser()
+
 def parse(tokens, customize):
     #
     #  Special handling for opcodes that take a variable number
@@ -1,49 +1,225 @@
 import os
 import sys
+import getopt
+import traceback
+import zipfile
 import uncompyle2
+from uncompyle2 import archive
 
-def decompile(file):
-    
-    if (os.path.isdir(file)):
-        dir = file
-        files = os.listdir(dir)
-        for f in files:
-            f = dir + "\\" + f
-            if (os.path.isdir(f)):
-                decompile(f)
-            else:
-                base, ext = os.path.splitext(f)
-                if ext == ".pyc" or ext == ".pyo":
-                    print("file: " + f)
-                    newfile = base +".uncompyled.py"
-                    print("new file: " + newfile)
-                    with open(newfile, "wb") as fileobj:
-                        uncompyle2.uncompyle_file(f, fileobj)
-    elif (os.path.isfile(file)):
-        print("file: " + file)
-        base, ext = os.path.splitext(file)
-        if ext == ".pyc" or ext == ".pyo":
-            newfile = base + ".uncompyled.py"
-            print("new file: " + newfile)
-            fileToDecompile = file
-            with open(newfile, "wb") as fileobj:
-                uncompyle2.uncompyle_file(fileToDecompile, fileobj)   
+EXTENSIONS = (".pyc", ".pyo")
+
+def output_name(file):
+    return os.path.splitext(file)[0] + ".uncompyled.py"
+
+def crawl_archive(file):
+    """
+    Yield the (input, output) pairs of the byte-code files in the zip
+    archive 'file'.  Inputs are (archive, member) pairs, outputs are
+    (archive, member) pairs naming the sources in the zip archive
+    <file without extension>.uncompyled.zip.
+    """
+    outarchive = os.path.splitext(file)[0] + ".uncompyled.zip"
+    for member in archive.members(file):
+        yield (file, member), (outarchive, output_name(member))
+
+def crawl(top):
+    """
+    Yield the (input, output) pairs of all .pyc/.pyo files in and below
+    'top' (or of 'top' itself if it is a byte-code file).  Zip archives
+    are looked into, see crawl_archive().
+
+    Directories are walked depth first with an explicit stack instead of
+    recursion; pairs are produced as soon as a directory has been read.
+    """
+    if not os.path.isdir(top):
+        if os.path.splitext(top)[1] in EXTENSIONS:
+            yield top, output_name(top)
+        elif archive.is_archive(top):
+            for pair in crawl_archive(top):
+                yield pair
+        return
+
+    stack = [top]
+    while stack:
+        dir = stack.pop()
+        try:
+            names = os.listdir(dir)
+        except OSError, e:
+            print >>sys.stderr, "### Can't read %s: %s" % (dir, e)
+            continue
+        names.sort()
+        subdirs = []
+        for name in names:
+            f = os.path.join(dir, name)
+            if os.path.isdir(f):
+                subdirs.append(f)
+            elif os.path.splitext(name)[1] in EXTENSIONS:
+                yield f, output_name(f)
+            elif archive.is_archive(f):
+                for pair in crawl_archive(f):
+                    yield pair
+        del names
+        # reversed, so that subdirectories are visited in sorted order
+        subdirs.reverse()
+        stack.extend(subdirs)
+
+def read_file_list(fp, sep="\n"):
+    """
+    Yield the names in a 'sep' separated file list read from 'fp' (for
+    instance the output of 'find -print0' with sep="\\0").  Names are
+    yielded as soon as they have been read.
+    """
+    if sep == "\n":
+        while 1:
+            line = fp.readline()
+            if not line:
+                break
+            line = line.rstrip("\r\n")
+            if line:
+                yield line
+        return
+
+    rest = ""
+    while 1:
+        data = os.read(fp.fileno(), 65536)
+        if not data:
+            break
+        names = (rest + data).split(sep)
+        rest = names.pop()
+        for name in names:
+            if name:
+                yield name
+    if rest:
+        yield rest
+
+def crawl_list(names):
+    """Crawl each of the files and directories in 'names'."""
+    for name in names:
+        for pair in crawl(name):
+            yield pair
+
+def decompile_file(pair):
+    """
+    Decompile one (input, output) pair, see crawl().  Return the pair,
+    the source if it goes to an archive, the status (None if okay,
+    'failed' or 'oom') and the error message.
+
+    Errors are returned rather than raised: an exception would have to
+    be pickled to get out of a worker, and the tokens of a ParserError
+    can't be.  A failed output file is renamed to *_failed.
+    """
+    file, newfile = pair
+    try:
+        if isinstance(file, tuple):
+            from cStringIO import StringIO
+            fileobj = StringIO()
+            uncompyle2.uncompyle_file(file[0], fileobj, member=file[1])
+            return pair, fileobj.getvalue(), None, None
+        with open(newfile, "wb") as fileobj:
+            uncompyle2.uncompyle_file(file, fileobj)
+        return pair, None, None, None
+    except Exception, e:
+        status = isinstance(e, MemoryError) and "oom" or "failed"
+        if not isinstance(newfile, tuple) and os.path.exists(newfile):
+            os.rename(newfile, newfile + "_" + status)
+        return pair, None, status, traceback.format_exc()
+
+def decompile_killed(pair, reason):
+    file, newfile = pair
+    if not isinstance(newfile, tuple) and os.path.exists(newfile):
+        os.rename(newfile, newfile + "_" + reason)
+    return pair, None, reason, None
+
+def display_name(name):
+    if isinstance(name, tuple):
+        return "/".join(name)
+    return name
+
+def decompile(file, workers=None, timeout=None, maxrss=None):
+    """
+    Decompile 'file', all byte-code files below the directory 'file' or,
+    if 'file' is an iterable, all files and directories named therein.
+
+    A file taking more than 'timeout' seconds or 'maxrss' megabytes of
+    memory is given up and its output renamed to *_timeout or *_oom.
+    """
+    if isinstance(file, basestring):
+        if not (os.path.exists(file)):
+            print("Error: file not found!")
+            raw_input()
+            exit(1)
+        pairs = crawl(file)
     else:
-        print("Error: file not found!")
-        raw_input()
-        exit(1)
+        pairs = crawl_list(file)
+
+    # results come back in input order, whichever worker finishes first;
+    # the members of an archive are consecutive, so only one output
+    # archive needs to be open at a time
+    outzip = None
+    try:
+        for (f, newfile), source, status, message in uncompyle2._imap(
+                decompile_file, pairs, workers, timeout, maxrss,
+                decompile_killed):
+            f = display_name(f)
+            print("file: " + f)
+            if message:
+                print("Error: can't decompile %s (%s)" % (f, status))
+                sys.stderr.write(message)
+                continue
+            if status:
+                print("Error: %s exceeded (%s)" % (f, status))
+                continue
+            if source is not None:
+                outarchive, member = newfile
+                if outzip is None or outzip.filename != outarchive:
+                    if outzip is not None:
+                        outzip.close()
+                    outzip = zipfile.ZipFile(outarchive, "w",
+                                             zipfile.ZIP_DEFLATED)
+                outzip.writestr(member, source)
+            print("new file: " + display_name(newfile))
+    finally:
+        if outzip is not None:
+            outzip.close()
 
 if __name__ == "__main__":
-    if (len(sys.argv) < 2):
+    usage = "Usage: Run.py [-j workers] [-t seconds] [-m megabytes] [-0] file|dir|-"
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'j:t:m:0')
+    except getopt.GetoptError, e:
+        print("Error: %s" % e)
+        print(usage)
+        exit(1)
+
+    if (len(args) < 1):
         print("Error: missing file arg!")
+        print(usage)
         raw_input()
         exit(1)
-    
-    filename = sys.argv[1]
-    
-    print("Decompiling....")    
-    
-    decompile(filename) 
-    
+
+    workers = timeout = maxrss = None
+    sep = "\n"
+    for opt, val in opts:
+        if opt == '-j':
+            workers = int(val)
+        elif opt == '-t':
+            timeout = float(val)
+        elif opt == '-m':
+            maxrss = int(val)
+        elif opt == '-0':
+            sep = "\0"
+
+    filename = args[0]
+
+    print("Decompiling....")
+
+    if filename == "-":
+        # read the file list from stdin; don't wait for a key press
+        decompile(read_file_list(sys.stdin, sep), workers, timeout, maxrss)
+        print("Done!")
+        exit(0)
+
+    decompile(filename, workers, timeout, maxrss)
+
     print("Done!")
-    raw_input("Press any key to continue...")    
+    raw_input("Press any key to continue...")
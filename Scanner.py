@@ -12,6 +12,11 @@ import dis
 from collections import namedtuple
 from array import array
 from operator import itemgetter
+from bisect import bisect_left, insort
+from heapq import heappush, heappop
+from itertools import groupby
+
+import hooks
 
 HAVE_ARGUMENT = dis.HAVE_ARGUMENT
 
@@ -22,22 +27,73 @@ PJIT = POP_JUMP_IF_TRUE
 JA = JUMP_ABSOLUTE
 JF = JUMP_FORWARD
 
-class Token:
+# the opcode classes of dis as sets
+HASCONST = frozenset(dis.hasconst)
+HASNAME = frozenset(dis.hasname)
+HASJREL = frozenset(dis.hasjrel)
+HASJABS = frozenset(dis.hasjabs)
+HASLOCAL = frozenset(dis.haslocal)
+HASCOMPARE = frozenset(dis.hascompare)
+HASFREE = frozenset(dis.hasfree)
+JUMP_OPS = HASJREL | HASJABS
+
+# longer spans of instructions are searched with instr_numbers()
+SCAN_MAX = 256
+# more structures than this are swept by open_structs()
+SWEEP_MIN = 16
+
+# opcodes whose argument is part of the token name (see disassemble())
+CUSTOMIZE_OPS = frozenset([
+    BUILD_LIST, BUILD_TUPLE, BUILD_SET, BUILD_SLICE, UNPACK_SEQUENCE,
+    MAKE_FUNCTION, CALL_FUNCTION, MAKE_CLOSURE, CALL_FUNCTION_VAR,
+    CALL_FUNCTION_KW, CALL_FUNCTION_VAR_KW, DUP_TOPX, RAISE_VARARGS])
+
+# the line of each offset and the offset where the next line starts, as
+# two arrays (see disassemble())
+linetuple = namedtuple('linetuple', ['l_no', 'next'])
+
+_opsets = {}
+
+def _opset(instr):
+    """Return the opcode or the opcodes 'instr' as a set."""
+    if isinstance(instr, (set, frozenset)):
+        return instr
+    try:
+        ops = _opsets.get(instr)
+    except TypeError: # a list
+        return frozenset(instr)
+    if ops is None:
+        if isinstance(instr, (int, long)):
+            ops = frozenset([instr])
+        else:
+            ops = frozenset(instr)
+        _opsets[instr] = ops
+    return ops
+
+class Token(object):
     """
     Class representing a byte-code token.
     
     A byte-code token is equivalent to the contents of one line
-    as output by dis.dis().
+    as output by dis.dis().  There is one per instruction, so tokens
+    have slots instead of a __dict__; a subclass should declare
+    __slots__ too.  'offset' is the offset of the instruction; a
+    COME_FROM has the offset of the instruction it precedes and, as
+    'attr', its number among the COME_FROMs there.
     """
+    __slots__ = ('type', 'attr', 'pattr', 'offset', 'linestart')
+
     def __init__(self, type_, attr=None, pattr=None, offset=-1, linestart=False):
-        self.type = intern(type_)
+        self.type = type_
         self.attr = attr
         self.pattr = pattr
         self.offset = offset
         self.linestart = linestart
         
     def __cmp__(self, o):
-        if isinstance(o, Token):
+        if o.__class__ is str:
+            return cmp(self.type, o)
+        elif isinstance(o, Token):
             # both are tokens: compare type and pattr 
             return cmp(self.type, o.type) or cmp(self.pattr, o.pattr)
         else:
@@ -46,14 +102,25 @@ class Token:
     def __repr__(self):		return str(self.type)
     def __str__(self):
         pattr = self.pattr
+        offset = self.offset
+        if self.type == 'COME_FROM':
+            offset = '%s_%d' % (offset, self.attr)
         if self.linestart:
-            return '\n%s\t%-17s %r' % (self.offset, self.type, pattr)
+            return '\n%s\t%-17s %r' % (offset, self.type, pattr)
         else:
-            return '%s\t%-17s %r' % (self.offset, self.type, pattr)
+            return '%s\t%-17s %r' % (offset, self.type, pattr)
 
     def __hash__(self):		return hash(self.type)
     def __getitem__(self, i):	raise IndexError
 
+    # slots are only pickled with protocol 2 unless these are defined
+    def __getstate__(self):
+        return [getattr(self, name) for name in Token.__slots__]
+
+    def __setstate__(self, state):
+        for name, value in zip(Token.__slots__, state):
+            setattr(self, name, value)
+
 
 class Code:
     """
@@ -85,7 +152,7 @@ class Scanner:
         self.out = out
             
     def setTokenClass(self, tokenClass):
-        assert type(tokenClass) == types.ClassType
+        assert issubclass(tokenClass, Token)
         self.Token = tokenClass
         
     def resetTokenClass(self):
@@ -94,9 +161,8 @@ class Scanner:
     def deobfuscate(self, co, linestarts, varnames):
         n = 0
         code = self.code
-        for i in self.op_range(0, len(code)):
-            if code[i] in (RETURN_VALUE, END_FINALLY):
-                n = i + 1
+        for i in self.all_instr(0, len(code), (RETURN_VALUE, END_FINALLY)):
+            n = i + 1
 
         fixed_code = array('B')
         linestartoffsets = {a:b for (a, b) in linestarts[1:]}
@@ -118,8 +184,9 @@ class Scanner:
                     m += 2
         
         self.code = code = fixed_code
+        self.build_instr_table()
         for i in self.op_range(0, m):
-            if code[i] in dis.hasjrel:
+            if code[i] in HASJREL:
                 #import pdb; pdb.set_trace()
                 old_jump = code[i+1] + code[i+2]*256
                 old_target = new_to_old[i] + 3 + old_jump
@@ -127,11 +194,12 @@ class Scanner:
                 new_jump = new_target - i - 3
                 code[i+1] = new_jump % 256
                 code[i+2] = new_jump // 256
-            if code[i] in dis.hasjabs:
+            if code[i] in HASJABS:
                 old_target = code[i+1] + code[i+2]*256
                 new_target = old_to_new[old_target]
                 code[i+1] = new_target % 256
                 code[i+2] = new_target // 256
+        self.build_instr_table() # new jump arguments
         
         for i in range(len(varnames)):
             varnames[i] = 'varnames_%s' % i
@@ -153,11 +221,18 @@ class Scanner:
         The main part of this procedure is modelled after
         dis.disassemble().
         """
+        if hooks.callbacks:
+            return hooks.call('disassemble', co.co_name, len(co.co_code),
+                              self._disassemble, co, classname, deob)
+        return self._disassemble(co, classname, deob)
+
+    def _disassemble(self, co, classname=None, deob=0):
         #import pdb; pdb.set_trace()
         rv = []
         customize = {}
         Token = self.Token # shortcut
         self.code = array('B', co.co_code)
+        self.build_instr_table()
 
         linestarts = list(dis.findlinestarts(co))
         varnames = list(co.co_varnames)
@@ -167,29 +242,33 @@ class Scanner:
         code = self.code
         n = len(code)
         
-        self.prev = [0]
-        for i in self.op_range(0, n):
-            op = code[i]
-            self.prev.append(i)
-            if op >= HAVE_ARGUMENT:
-                self.prev.append(i)
-                self.prev.append(i)
-                
-        self.lines = []
-        linetuple = namedtuple('linetuple', ['l_no', 'next'])
+        # self.prev[i] is the offset of the instruction before the one
+        # containing offset i
+        prev = [0]
+        ops = self.ops
+        for k, i in enumerate(self.offsets):
+            prev.append(i)
+            if ops[k] >= HAVE_ARGUMENT:
+                prev.append(i)
+                prev.append(i)
+        self.prev = array('i', prev)
+
+        # self.lines.l_no[i] is the line of offset i and self.lines.next[i]
+        # the offset where the next line starts
+        self.lines = lines = linetuple(array('i'), array('i'))
         j = 0
         
         linestartoffsets = {a for (a, _) in linestarts}
         (prev_start_byte, prev_line_no) = linestarts[0]
         for (start_byte, line_no) in linestarts[1:]:
-            while j < start_byte:
-                self.lines.append(linetuple(prev_line_no, start_byte))
-                j += 1
-            last_op = code[self.prev[start_byte]]
+            if j < start_byte:
+                lines.l_no.extend(array('i', [prev_line_no]) * (start_byte - j))
+                lines.next.extend(array('i', [start_byte]) * (start_byte - j))
+                j = start_byte
             (prev_start_byte, prev_line_no) = (start_byte, line_no)
-        while j < n:
-            self.lines.append(linetuple(prev_line_no, n))
-            j+=1
+        if j < n:
+            lines.l_no.extend(array('i', [prev_line_no]) * (n - j))
+            lines.next.extend(array('i', [n]) * (n - j))
         
         if classname:
             classname = '_' + classname.lstrip('_') + '__'
@@ -206,18 +285,22 @@ class Scanner:
             names = co.co_names
 
         self.load_asserts = set()
-        for i in self.op_range(0, n):
-            if code[i] == PJIT and code[i+3] == LOAD_GLOBAL:
+        for i in self.all_instr(0, n, PJIT):
+            if code[i+3] == LOAD_GLOBAL:
                 if names[code[i+4] + 256*code[i+5]] == 'AssertionError':
                     self.load_asserts.add(i+3)
                     
-        cf = self.find_jump_targets(code)
+        if hooks.callbacks:
+            cf = hooks.call('find_jump_targets', co.co_name, n,
+                            self.find_jump_targets, code)
+        else:
+            cf = self.find_jump_targets(code)
 
         last_stmt = self.next_stmt[0]
         i = self.next_stmt[last_stmt]
         replace = {}
         while i < n-1:
-            if self.lines[last_stmt].next > i:
+            if self.lines.next[last_stmt] > i:
                 if code[last_stmt] == PRINT_ITEM:
                     if code[i] == PRINT_ITEM:
                         replace[i] = 'PRINT_ITEM_CONT'
@@ -230,7 +313,7 @@ class Scanner:
         if len(imports) > 1:
             last_import = imports[0]
             for i in imports[1:]:
-                if self.lines[last_import].next > i:
+                if self.lines.next[last_import] > i:
                     if code[last_import] == IMPORT_NAME == code[i]:
                         replace[i] = 'IMPORT_NAME_CONT'
                 last_import = i
@@ -241,8 +324,7 @@ class Scanner:
             if offset in cf:
                 k = 0
                 for j in cf[offset]:
-                    rv.append(Token('COME_FROM', None, repr(j),
-                                    offset="%s_%d" % (offset, k) ))
+                    rv.append(Token('COME_FROM', k, repr(j), offset))
                     k += 1
                     
             op = code[offset]
@@ -254,7 +336,7 @@ class Scanner:
                 if op == dis.EXTENDED_ARG:
                     extended_arg = oparg * 65536L
                     continue
-                if op in dis.hasconst:
+                if op in HASCONST:
                     const = co.co_consts[oparg]
                     if type(const) == types.CodeType:
                         oparg = const
@@ -275,25 +357,20 @@ class Scanner:
                         pattr = '<code_object ' + const.co_name + '>'
                     else:
                         pattr = const
-                elif op in dis.hasname:
+                elif op in HASNAME:
                     pattr = names[oparg]
-                elif op in dis.hasjrel:
+                elif op in HASJREL:
                     pattr = repr(offset + 3 + oparg)
-                elif op in dis.hasjabs:
+                elif op in HASJABS:
                     pattr = repr(oparg)
-                elif op in dis.haslocal:
+                elif op in HASLOCAL:
                     pattr = varnames[oparg]
-                elif op in dis.hascompare:
+                elif op in HASCOMPARE:
                     pattr = dis.cmp_op[oparg]
-                elif op in dis.hasfree:
+                elif op in HASFREE:
                     pattr = free[oparg]
 
-            if op in (BUILD_LIST, BUILD_TUPLE, BUILD_SET, BUILD_SLICE,
-                            UNPACK_SEQUENCE,
-                            MAKE_FUNCTION, CALL_FUNCTION, MAKE_CLOSURE,
-                            CALL_FUNCTION_VAR, CALL_FUNCTION_KW,
-                            CALL_FUNCTION_VAR_KW, DUP_TOPX, RAISE_VARARGS
-                            ):
+            if op in CUSTOMIZE_OPS:
                 # CE - Hack for >= 2.5
                 #      Now all values loaded via LOAD_CLOSURE are packed into
                 #      a tuple before calling MAKE_CLOSURE.
@@ -301,7 +378,7 @@ class Scanner:
                     code[self.prev[offset]] == LOAD_CLOSURE:
                     continue
                 else:
-                    opname = '%s_%d' % (opname, oparg)
+                    opname = intern('%s_%d' % (opname, oparg))
                     if op != BUILD_SLICE:
                         customize[opname] = oparg
             elif op == JA:
@@ -337,10 +414,114 @@ class Scanner:
         if op is None:
             op = self.code[pos]
         target = self.code[pos+1] + self.code[pos+2] * 256
-        if op in dis.hasjrel:
+        if op in HASJREL:
             target += pos + 3
         return target
 
+    def build_instr_table(self):
+        """
+        Decode self.code once for the helpers below.  Instruction k
+        starts at offset self.offsets[k] with opcode self.ops[k]; for an
+        instruction with an argument, self.targets[k] is its target as
+        get_target() returns it (0 for the others).  The indexes by
+        opcode and by target are built when a query first needs them
+        (see instr_numbers()).
+        """
+        code = self.code
+        n = len(code)
+        offsets = []
+        targets = []
+        i = 0
+        while i < n:
+            op = code[i]
+            offsets.append(i)
+            if op < HAVE_ARGUMENT:
+                targets.append(0)
+                i += 1
+                continue
+            if i + 2 >= n: # truncated
+                targets.append(0)
+            elif op in HASJREL:
+                targets.append(code[i+1] + code[i+2] * 256 + i + 3)
+            else:
+                targets.append(code[i+1] + code[i+2] * 256)
+            i += 3
+        self.offsets = array('i', offsets)
+        self.ops = array('B', [code[i] for i in offsets])
+        self.targets = array('i', targets)
+        self.by_op = self.sources = None
+
+    def build_op_index(self):
+        """
+        Build self.by_op, which maps each opcode to the numbers of its
+        instructions in order.
+        """
+        ops = self.ops
+        self.by_op = by_op = {}
+        # sorted() is stable: the numbers of an opcode stay in order
+        for op, ks in groupby(sorted(xrange(len(ops)), key=ops.__getitem__),
+                              ops.__getitem__):
+            by_op[op] = array('i', ks)
+
+    def build_jump_index(self):
+        """
+        Build self.sources, which maps each target to the numbers of the
+        jump instructions to it in order.
+        """
+        if self.by_op is None:
+            self.build_op_index()
+        targets = self.targets
+        jumps = []
+        for op in JUMP_OPS:
+            jumps.extend(self.by_op.get(op, ()))
+        jumps.sort()
+        jumps.sort(key=targets.__getitem__)
+        self.sources = sources = {}
+        for target, ks in groupby(jumps, targets.__getitem__):
+            sources[target] = array('i', ks)
+
+    def instr_span(self, start, end):
+        """
+        Return the numbers of the first instruction starting at start or
+        later and of the first one starting at end or later.
+        """
+        if start >= end:
+            return 0, 0
+        offsets = self.offsets
+        return bisect_left(offsets, start), bisect_left(offsets, end)
+
+    def instr_numbers(self, k0, k1, instr, target=None):
+        """
+        Return the numbers from k0 to k1 of the instructions whose
+        opcode is in the set 'instr' and, unless target is None, whose
+        target is 'target', in order.
+
+        The instructions are looked up by bisection in the index by
+        target (for jumps) or by opcode, so that the queries of
+        detect_structure() over long spans do not grow with the size of
+        the code object.
+        """
+        ops = self.ops
+        if target is not None and instr <= JUMP_OPS:
+            if self.sources is None:
+                self.build_jump_index()
+            ks = self.sources.get(target, ())
+            return [k for k in ks[bisect_left(ks, k0):bisect_left(ks, k1)]
+                    if ops[k] in instr]
+        if self.by_op is None:
+            self.build_op_index()
+        result = []
+        for op in instr:
+            ks = self.by_op.get(op)
+            if ks:
+                result.extend(ks[bisect_left(ks, k0):bisect_left(ks, k1)])
+        if len(instr) > 1:
+            result.sort()
+        if target is not None:
+            targets = self.targets
+            result = [k for k in result if targets[k] == target]
+        return result
+
     def first_instr(self, start, end, instr, target=None, exact=True):
         """
         Find the first <instr> in the block from start to end.
@@ -355,24 +536,28 @@ class Scanner:
         code = self.code
         assert(start>=0 and end<=len(code))
 
-        try:    None in instr
-        except: instr = [instr]
-
+        instr = _opset(instr)
+        k0, k1 = self.instr_span(start, end)
+        if k1 - k0 > SCAN_MAX and (target is None or exact):
+            ks = self.instr_numbers(k0, k1, instr, target)
+            if ks:
+                return self.offsets[ks[0]]
+            return None
+        ops = self.ops
         pos = None
         distance = len(code)
-        for i in self.op_range(start, end):
-            op = code[i]
-            if op in instr:
+        for k in xrange(k0, k1):
+            if ops[k] in instr:
                 if target is None:
-                    return i
-                dest = self.get_target(i, op)
+                    return self.offsets[k]
+                dest = self.targets[k]
                 if dest == target:
-                    return i
+                    return self.offsets[k]
                 elif not exact:
                     _distance = abs(target - dest)
                     if _distance < distance:
                         distance = _distance
-                        pos = i
+                        pos = self.offsets[k]
         return pos
 
     def last_instr(self, start, end, instr, target=None, exact=True):
@@ -391,26 +576,30 @@ class Scanner:
         if not (start>=0 and end<=len(code)):
             return None
 
-        try:    None in instr
-        except: instr = [instr]
-
+        instr = _opset(instr)
+        k0, k1 = self.instr_span(start, end)
+        if k1 - k0 > SCAN_MAX and (target is None or exact):
+            ks = self.instr_numbers(k0, k1, instr, target)
+            if ks:
+                return self.offsets[ks[-1]]
+            return None
+        ops = self.ops
         pos = None
         distance = len(code)
-        for i in self.op_range(start, end):
-            op = code[i]
-            if op in instr:
+        for k in xrange(k0, k1):
+            if ops[k] in instr:
                 if target is None:
-                    pos = i
+                    pos = self.offsets[k]
                 else:
-                    dest = self.get_target(i, op)
+                    dest = self.targets[k]
                     if dest == target:
                         distance = 0
-                        pos = i
+                        pos = self.offsets[k]
                     elif not exact:
                         _distance = abs(target - dest)
                         if _distance <= distance:
                             distance = _distance
-                            pos = i
+                            pos = self.offsets[k]
         return pos
 
     def all_instr(self, start, end, instr, target=None, include_beyond_target=False):
@@ -423,24 +612,32 @@ class Scanner:
         Return a list with indexes to them or [] if none found.
         """
         
-        code = self.code
-        assert(start>=0 and end<=len(code))
-
-        try:    None in instr
-        except: instr = [instr]
-
+        assert(start>=0 and end<=len(self.code))
+
+        instr = _opset(instr)
+        ops, offsets = self.ops, self.offsets
+        k0, k1 = self.instr_span(start, end)
+        if k1 - k0 > SCAN_MAX:
+            if include_beyond_target and target is not None:
+                targets = self.targets
+                return [offsets[k] for k in self.instr_numbers(k0, k1, instr)
+                        if targets[k] >= target]
+            return [offsets[k] for k in
+                    self.instr_numbers(k0, k1, instr, target)]
         result = []
-        for i in self.op_range(start, end):
-            op = code[i]
-            if op in instr:
-                if target is None:
-                    result.append(i)
-                else:
-                    t = self.get_target(i, op)
-                    if include_beyond_target and t >= target:
-                        result.append(i)
-                    elif t == target:
-                        result.append(i)
+        if target is None:
+            for k in xrange(k0, k1):
+                if ops[k] in instr:
+                    result.append(offsets[k])
+            return result
+        targets = self.targets
+        for k in xrange(k0, k1):
+            if ops[k] in instr:
+                t = targets[k]
+                if include_beyond_target and t >= target:
+                    result.append(offsets[k])
+                elif t == target:
+                    result.append(offsets[k])
         return result
 
     def op_size(self, op):
@@ -450,9 +647,8 @@ class Scanner:
             return 3
             
     def op_range(self, start, end):
-        while start < end:
-            yield start
-            start += self.op_size(self.code[start])
+        """Return the offsets of the instructions starting from start to end."""
+        return self.offsets[slice(*self.instr_span(start, end))]
 
     def build_stmt_indices(self):
         code = self.code
@@ -485,17 +681,11 @@ class Scanner:
         stmts = self.stmts = set(prelim)
                 
         pass_stmts = set()
+        ops, offsets = self.ops, self.offsets
         for seq in stmt_opcode_seqs:
-            for i in self.op_range(start, end-(len(seq)+1)):
-                match = True
-                for elem in seq:
-                    if elem != code[i]:
-                        match = False
-                        break
-                    i += self.op_size(code[i])
-                    
-                if match:
-                    i = self.prev[i]
+            for k in xrange(*self.instr_span(start, end-(len(seq)+1))):
+                if ops[k] == seq[0] and tuple(ops[k:k+len(seq)]) == seq:
+                    i = offsets[k+len(seq)-1]
                     stmts.add(i)
                     pass_stmts.add(i)
         
@@ -505,13 +695,12 @@ class Scanner:
         else:
             stmt_list = prelim
         last_stmt = -1
-        self.next_stmt = []
-        slist = self.next_stmt = []
+        slist = self.next_stmt = array('i')
         i = 0
         for s in stmt_list:
             if code[s] == JA and s not in pass_stmts:
                 target = self.get_target(s)
-                if target > s or self.lines[last_stmt].l_no == self.lines[s].l_no:
+                if target > s or self.lines.l_no[last_stmt] == self.lines.l_no[s]:
                     stmts.remove(s)
                     continue
                 j = self.prev[s]
@@ -531,16 +720,16 @@ class Scanner:
                     stmts.remove(s)
                     continue
             last_stmt = s
-            slist += [s] * (s-i)
+            slist += array('i', [s]) * (s-i)
             i = s
-        slist += [len(code)] * (len(code)-len(slist))
+        slist += array('i', [len(code)]) * (len(code)-len(slist))
                     
                
     def remove_mid_line_ifs(self, ifs):
         filtered = []
         for i in ifs:
-            if self.lines[i].l_no == self.lines[i+3].l_no:
-                if self.code[self.prev[self.lines[i].next]] in (PJIT, PJIF):
+            if self.lines.l_no[i] == self.lines.l_no[i+3]:
+                if self.code[self.prev[self.lines.next[i]]] in (PJIT, PJIF):
                     continue
             filtered.append(i)
         return filtered
@@ -556,25 +745,7 @@ class Scanner:
         Return a list with indexes to them or [] if none found.
         """
         
-        code = self.code
-        assert(start>=0 and end<=len(code))
-
-        try:    None in instr
-        except: instr = [instr]
-
-        result = []
-        for i in self.op_range(start, end):
-            op = code[i]
-            if op in instr:
-                if target is None:
-                    result.append(i)
-                else:
-                    t = self.get_target(i, op)
-                    if include_beyond_target and t >= target:
-                        result.append(i)
-                    elif t == target:
-                        result.append(i)
-                        
+        result = self.all_instr(start, end, instr, target, include_beyond_target)
         pjits = self.all_instr(start, end, PJIT)
         filtered = []
         for pjit in pjits:
@@ -614,6 +785,35 @@ class Scanner:
                 count_SETUP_ += 1
         
 
+    def open_structs(self, pos):
+        """
+        Return the numbers of the structures in self.structs which
+        contain pos, in the order they were added.
+
+        find_jump_targets() visits the code in order, so the structures
+        are swept instead of being scanned at each instruction: they wait
+        in a heap by start offset until pos reaches them, then in a heap
+        by end offset until pos reaches their end.  A query going back
+        in the code, or made while there are at most SWEEP_MIN
+        structures, gets all of them; the sweep catches up later.
+        """
+        structs = self.structs
+        if pos < self.struct_pos or len(structs) <= SWEEP_MIN:
+            return xrange(len(structs))
+        self.struct_pos = pos
+        pending = self.pending_structs
+        for i in xrange(self.struct_count, len(structs)):
+            heappush(pending, (structs[i]['start'], i))
+        self.struct_count = len(structs)
+        active, ends = self.active_structs, self.struct_ends
+        while pending and pending[0][0] <= pos:
+            i = heappop(pending)[1]
+            insort(active, i)
+            heappush(ends, (structs[i]['end'], i))
+        while ends and ends[0][0] <= pos:
+            active.remove(heappop(ends)[1])
+        return active
+
     def restrict_to_parent(self, target, parent):
         """Restrict pos to parent boundaries."""
         if not (parent['start'] < target < parent['end']):
@@ -635,10 +835,12 @@ class Scanner:
             op = code[pos]
 
         ## Detect parent structure
-        parent = self.structs[0]
+        structs = self.structs
+        parent = structs[0]
         start  = parent['start']
         end    = parent['end']
-        for s in self.structs:
+        for k in self.open_structs(pos):
+            s = structs[k]
             _start = s['start']
             _end   = s['end']
             if (_start <= pos < _end) and (_start >= start and _end <= end):
@@ -657,7 +859,7 @@ class Scanner:
             if target != end:
                 self.fixed_jumps[pos] = end
             
-            (line_no, next_line_byte) = self.lines[pos]
+            line_no, next_line_byte = self.lines.l_no[pos], self.lines.next[pos]
             jump_back = self.last_instr(start, end, JA,
                                           next_line_byte, False)
                                           
@@ -806,7 +1008,7 @@ class Scanner:
                             last_jump_good = True
                             for j in jump_ifs:
                                 if target == self.get_target(j):
-                                    if self.lines[j].next == j+3 and last_jump_good:
+                                    if self.lines.next[j] == j+3 and last_jump_good:
                                         fix = j
                                         break
                                 else:
@@ -904,13 +1106,18 @@ class Scanner:
         for each target the number of jumps are counted.
         """
 
-        hasjrel = dis.hasjrel
-        hasjabs = dis.hasjabs
+        hasjrel = HASJREL
+        hasjabs = HASJABS
 
         n = len(code)
         self.structs = [{'type':  'root',
                            'start': 0,
                            'end':   n-1}]
+        ## State of open_structs()
+        self.struct_pos = self.struct_count = 0
+        self.pending_structs = []
+        self.active_structs = []
+        self.struct_ends = []
         self.loops = []  ## All loop entry points
         self.fixed_jumps = {} ## Map fixed jumps to their real destination
         self.ignore_if = set()
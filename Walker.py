@@ -38,12 +38,13 @@
 #  makes the engine walk down to N[C] before evaluating the escape code.
 #
 
-import sys, re, cStringIO
+import sys, re, time, cStringIO, marshal, hashlib, signal, dis
+from collections import OrderedDict
 from types import ListType, TupleType, DictType, \
      EllipsisType, IntType, CodeType
 
 from spark import GenericASTTraversal
-import Parser
+import Parser, hooks
 from Parser import AST
 from Scanner import Token, Code
 
@@ -393,8 +394,16 @@ escape = re.compile(r'''
                  ( [{] (?P<expr> [^}]* ) [}] ))
         ''', re.VERBOSE)
 
+def node_context(node):
+    """Return the names a '%{...}' of the tables is evaluated with."""
+    try:
+        return node.__dict__
+    except AttributeError: # tokens have slots
+        return dict([(name, getattr(node, name)) for name in Token.__slots__])
+
 class ParserError(Parser.ParserError):
     def __init__(self, error, tokens):
+        Exception.__init__(self, error, tokens) # for pickling
         self.error = error # previous exception
         self.tokens = tokens
 
@@ -404,6 +413,53 @@ class ParserError(Parser.ParserError):
         lines.extend( ['', str(self.error)] )
         return '\n'.join(lines)
 
+class CodeTimeout(Exception):
+    """A code object took longer than the walker's time budget."""
+
+def _alarm(signum, frame):
+    raise CodeTimeout()
+
+def disassemble(co):
+    """
+    Return the instructions of code object 'co' as lines of text,
+    straight from co_code, for the stubs of functions which could
+    not be decompiled.
+    """
+    code = co.co_code
+    free = co.co_cellvars + co.co_freevars
+    lines = []
+    i, n, extended = 0, len(code), 0
+    while i < n:
+        op = ord(code[i])
+        line = '%d\t%s' % (i, dis.opname[op])
+        i += 1
+        if op >= dis.HAVE_ARGUMENT:
+            arg = ord(code[i]) + ord(code[i+1]) * 256 + extended
+            i += 2
+            extended = 0
+            if op == dis.EXTENDED_ARG:
+                extended = arg * 65536
+            elif op in dis.hasconst:
+                const = co.co_consts[arg]
+                if type(const) == CodeType:
+                    line += ' <code object %s>' % const.co_name
+                else:
+                    line += ' ' + repr(const)[:60]
+            elif op in dis.hasname:
+                line += ' ' + co.co_names[arg]
+            elif op in dis.haslocal:
+                line += ' ' + co.co_varnames[arg]
+            elif op in dis.hasfree:
+                line += ' ' + free[arg]
+            elif op in dis.hascompare:
+                line += ' ' + dis.cmp_op[arg]
+            elif op in dis.hasjrel:
+                line += ' to %d' % (i + arg)
+            else:
+                line += ' %d' % arg
+        lines.append(line)
+    return lines
+
 
 def find_globals(node, globs):
     """Find globals in this statement."""
@@ -423,6 +479,16 @@ def find_all_globals(node, globs):
             globs.add(n.pattr)
     return globs
 
+def count_nodes(node):
+    """Count the nodes (including the tokens) of an AST."""
+    n = 1
+    for kid in node:
+        if isinstance(kid, AST):
+            n += count_nodes(kid)
+        else:
+            n += 1
+    return n
+
 def find_none(node):
     for n in node:
         if isinstance(n, AST):
@@ -433,12 +499,118 @@ def find_none(node):
             return True
     return False
 
+def code_fingerprint(co):
+    """
+    Return what determines the source of code object 'co' apart from
+    its position: co_filename, co_firstlineno and co_lnotab are left
+    out.  Nested code objects are included with their co_name.
+    """
+    consts = []
+    for c in co.co_consts:
+        if type(c) == CodeType:
+            # a list, which no constant can be
+            c = [c.co_name, code_fingerprint(c)]
+        consts.append(c)
+    return (co.co_code, tuple(consts), co.co_names, co.co_varnames,
+            co.co_freevars, co.co_cellvars, co.co_argcount,
+            co.co_flags & ~CO_NESTED) # nested or not, the source is the same
+
+def code_names(co, names=None):
+    """
+    Return the set of the names of code object 'co' and the nested ones,
+    which hold every global its source may declare.
+    """
+    if names is None:
+        names = set()
+    names.update(co.co_names)
+    for c in co.co_consts:
+        if type(c) == CodeType:
+            code_names(c, names)
+    return names
+
+def has_mangled_names(co, classname):
+    """
+    Return true if code object 'co' or a nested one has a name which
+    Scanner.disassemble() unmangles within class 'classname'.
+    """
+    prefix = '_' + classname.lstrip('_') + '__'
+    for name in co.co_names + co.co_varnames + co.co_freevars + co.co_cellvars:
+        if name.startswith(prefix):
+            return True
+    for c in co.co_consts:
+        if type(c) == CodeType and has_mangled_names(c, classname):
+            return True
+    return False
+
+CO_OPTIMIZED = 0x1
+CO_NESTED = 0x10
+
+# the indentation of memoized bodies; repr() escapes it everywhere else
+MARK = '\0'
+
+class BodyCache:
+    """
+    LRU cache of the source of function and class bodies, shared by all
+    Walkers of a process.  Equal functions are common: helpers copied
+    from module to module, generated accessors, a module compiled from
+    several paths.  A body is stored with MARK as its indentation and
+    re-indented where it is used again.  'maxsize' limits the total
+    length of the stored sources; 0 disables the cache.
+    """
+    def __init__(self, maxsize=16*1024*1024):
+        self.maxsize = maxsize
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        body = self.entries.pop(key, None)
+        if body is None:
+            self.misses += 1
+        else:
+            self.entries[key] = body # most recently used
+            self.hits += 1
+        return body
+
+    def put(self, key, body):
+        if len(body[0]) > self.maxsize:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old[0])
+        self.entries[key] = body
+        self.size += len(body[0])
+        while self.size > self.maxsize:
+            key, old = self.entries.popitem(last=False)
+            self.size -= len(old[0])
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+body_cache = BodyCache()
+
 class Walker(GenericASTTraversal, object):
     stacked_params = ('f', 'indent', 'isLambda', '_globals')
 
-    def __init__(self, out, scanner, showast=0):
+    def __init__(self, out, scanner, showast=0, stats=None, isolate=0,
+                 budget=None, profiler=None):
         GenericASTTraversal.__init__(self, ast=None)
         self.scanner = scanner
+        # with isolate, a function or class body which can't be
+        # decompiled, or whose scanning and parsing takes longer than
+        # budget seconds, is replaced by a stub (see write_stub());
+        # stubs lists the (name, reason) of each
+        self.isolate = isolate or budget
+        self.budget = budget
+        self.stubs = []
+        # if a dict, the time spent scanning and parsing nested code
+        # objects and the number of tokens and AST nodes are added up
+        # in its 'scan', 'parse', 'tokens' and 'nodes' items
+        self.stats = stats
+        # if a profiling.StageProfiler, nested code objects are scanned
+        # and parsed in its 'scan' and 'parse' stages
+        self.profiler = profiler
         params = {
             'f': out,
             'indent': '',
@@ -912,10 +1084,10 @@ class Walker(GenericASTTraversal, object):
         code = node[-5].attr
 
         assert type(code) == CodeType
-        code = Code(code, self.scanner, self.currentclass)
+        code = self.make_code(code)
         #assert isinstance(code, Code)
 
-        ast = self.build_ast(code._tokens, code._customize)
+        ast = self.build_ast(code._tokens, code._customize, name=code.co_name)
         self.customize(code._customize)
         ast = ast[0][0][0]
         
@@ -1115,7 +1287,7 @@ class Walker(GenericASTTraversal, object):
                 if m.group('child'):
                     node = node[int(m.group('child'))]
             except:
-                print node.__dict__
+                print node_context(node)
                 raise
 
             if   typ == '%':	self.write('%')
@@ -1158,7 +1330,7 @@ class Walker(GenericASTTraversal, object):
                 self.prec = p
                 arg += 1
             elif typ == '{':
-                d = node.__dict__
+                d = node_context(node)
                 expr = m.group('expr')
                 try:
                     self.write(eval(expr, d, d))
@@ -1260,6 +1432,8 @@ class Walker(GenericASTTraversal, object):
             # if formal parameter is a tuple, the paramater name
             # starts with a dot (eg. '.1', '.2')
             if name.startswith('.'):
+                if ast is None: # in a stub
+                    return '_arg' + name[1:]
                 # replace the name with the tuple-string
                 name = self.get_tuple_parameter(ast, name)
 
@@ -1278,8 +1452,11 @@ class Walker(GenericASTTraversal, object):
         code = node[-2].attr
 
         assert type(code) == CodeType
-        code = Code(code, self.scanner, self.currentclass)
-        #assert isinstance(code, Code)
+        key = body = None
+        if not isLambda:
+            key = self.memo_key(code)
+            if key:
+                body = body_cache.get(key)
 
         # add defaults values to parameter names
         argc = code.co_argcount
@@ -1288,15 +1465,24 @@ class Walker(GenericASTTraversal, object):
         # defaults are for last n parameters, thus reverse
         paramnames.reverse(); defparams.reverse()
 
-        try:
-            ast = self.build_ast(code._tokens,
-                                 code._customize,
-                                 isLambda = isLambda,
-                                 noneInNames = ('None' in code.co_names))
-        except ParserError as p:
-            self.write( str(p))
-            self.ERROR = p
-            return
+        co = code
+        ast = failure = None
+        if body is None:
+            try:
+                code, ast = self.within_budget(self.scan_and_parse, co,
+                                               isLambda, 'None' in co.co_names)
+            except ParserError as p:
+                if isLambda or not self.isolate:
+                    self.write( str(p))
+                    self.ERROR = p
+                    return
+                failure = p
+            except MemoryError:
+                raise
+            except Exception, e:
+                if isLambda or not self.isolate:
+                    raise
+                failure = e
             
         # build parameters
        
@@ -1318,16 +1504,25 @@ class Walker(GenericASTTraversal, object):
             argc += 1
 
         # dump parameter list (with default values)
-        indent = self.indent
         if isLambda:
             self.write("lambda ", ", ".join(params), ": ")
         else:
             self.print_("(", ", ".join(params), "):")
             #self.print_(indent, '#flags:\t', int(code.co_flags))
 
+        if failure:
+            self.write_stub(co, failure)
+        elif isLambda:
+            self.function_body(code, ast, isLambda)
+        else:
+            self.write_memo(key, body, self.isolated, co,
+                            self.function_body, code, ast, isLambda)
+
+    def function_body(self, code, ast, isLambda):
+        """Dump doc string and body of a function (see make_function())."""
         if len(code.co_consts)>0 and code.co_consts[0] != None: 
             # docstring exists, dump it
-            self.print_docstring(indent, code.co_consts[0])
+            self.print_docstring(self.indent, code.co_consts[0])
 
         
         code._tokens = None # save memory
@@ -1350,19 +1545,23 @@ class Walker(GenericASTTraversal, object):
            self.print_(self.indent, 'global ', g)
         self.mod_globs -= all_globals
         rn = ('None' in code.co_names) and not find_none(ast)
-        self.gen_source(ast, code._customize, isLambda=isLambda, returnNone=rn)
+        self.gen_source(ast, code._customize, isLambda=isLambda, returnNone=rn,
+                        name=code.co_name)
         code._tokens = None; code._customize = None # save memory
         
     def build_class(self, code):
         """Dump class definition, doc string and class body."""
 
         assert type(code) == CodeType
-        code = Code(code, self.scanner, self.currentclass)
-        #assert isinstance(code, Code)
+        key = self.memo_key(code)
+        body = key and body_cache.get(key)
+        self.write_memo(key, body, self.isolated, code, self.class_body, code)
 
+    def class_body(self, code):
         indent = self.indent
+        code, ast = self.within_budget(self.scan_and_parse, code)
+        #assert isinstance(code, Code)
         #self.print_(indent, '#flags:\t', int(code.co_flags))
-        ast = self.build_ast(code._tokens, code._customize)
         code._tokens = None # save memory
         assert ast == 'stmts'
 
@@ -1386,13 +1585,241 @@ class Walker(GenericASTTraversal, object):
         for g in find_globals(ast, set()):
            self.print_(indent, 'global ', g)
            
-        self.gen_source(ast, code._customize)
+        self.gen_source(ast, code._customize, name=code.co_name)
         code._tokens = None; code._customize = None # save memory
 
 
-    def gen_source(self, ast, customize, isLambda=0, returnNone=False):
+    def memo_key(self, co):
+        """
+        Return the key of the body of code object 'co' in body_cache, or
+        None if it must not be memoized.  Besides the fingerprint of
+        'co', the key holds everything of the walker the body depends on;
+        of mod_globs, only the names 'co' uses, so that a function
+        declaring other globals earlier in the module does not change it.
+        Nothing is memoized while hooks are registered, which would miss
+        the stages of a cached body.
+        """
+        if not body_cache.maxsize or hooks.callbacks or self.showast \
+               or getattr(self.scanner, 'showasm', 0):
+            return None
+        for name in co.co_varnames[:co.co_argcount]:
+            if name.startswith('.'):
+                return None # tuple parameters are taken from the AST
+        classname = self.currentclass
+        if classname and not has_mangled_names(co, classname):
+            classname = None # the same source in any class
+        try:
+            data = marshal.dumps((code_fingerprint(co), classname,
+                                  self.prec,
+                                  sorted(self.mod_globs & code_names(co))))
+        except ValueError: # unmarshallable constant
+            return None
+        return hashlib.sha1(data).digest()
+
+    def render_body(self, co):
+        """
+        Render the body of the function or class of code object 'co'
+        into body_cache the way make_function() or build_class() would,
+        with currentclass and mod_globs set as they will be there.
+        Return the key or None if the body can't be memoized.
+        """
+        key = self.memo_key(co)
+        if key is None:
+            return None
+        if co.co_flags & CO_OPTIMIZED: # a function, not a class body
+            try:
+                code, ast = self.within_budget(self.scan_and_parse, co, 0,
+                                               'None' in co.co_names)
+            except Exception:
+                return None # make_function() will report it
+            self.write_memo(key, None, self.isolated, co,
+                            self.function_body, code, ast, 0)
+        else:
+            self.write_memo(key, None, self.isolated, co, self.class_body, co)
+        return key
+
+    def capture(self, render, *args):
+        """
+        Call render(*args) with its output going into a buffer.  Return
+        the body (see write_body()) and sys.exc_info() if render raised
+        an exception, else None.  The body is indented with MARK.
+        """
+        saved = self.f, self.indent, self.pending_newlines
+        globs = set(self.mod_globs)
+        self.f = cStringIO.StringIO()
+        self.indent = MARK
+        self.pending_newlines = 0
+        exc = None
+        try:
+            render(*args)
+        except:
+            exc = sys.exc_info()
+        # the output so far, newlines to be written, globals declared
+        body = (self.f.getvalue(), self.pending_newlines,
+                frozenset(globs - self.mod_globs))
+        self.f, self.indent, self.pending_newlines = saved
+        self.mod_globs = globs
+        return body, exc
+
+    def write_body(self, body):
+        """Replay what the render() of capture() did to the output and the walker."""
+        text, pending, globs = body
+        self.mod_globs -= globs
+        if not text:
+            self.pending_newlines = max(self.pending_newlines, pending)
+            return
+        n = len(text) - len(text.lstrip('\n'))
+        self.f.write('\n' * max(self.pending_newlines, n))
+        self.f.write(text[n:].replace(MARK, self.indent))
+        self.pending_newlines = pending
+
+    def write_memo(self, key, body, render, *args):
+        """
+        Write 'body', the memoized output of render(*args).  If body is
+        None, call render(*args) instead; with a key, its output is
+        memoized if no error occurs.
+        """
+        if body is not None:
+            self.write_body(body)
+        elif key is None:
+            render(*args)
+        else:
+            error, stubs = self.ERROR, len(self.stubs)
+            body, exc = self.capture(render, *args)
+            self.write_body(body)
+            if exc:
+                raise exc[0], exc[1], exc[2]
+            # stubs may be due to the time budget, don't keep them
+            if self.ERROR is error and len(self.stubs) == stubs:
+                body_cache.put(key, body)
+
+    def isolated(self, co, render, *args):
+        """
+        Call render(*args), which writes the body of code object 'co'.
+        With isolate, a body which fails (including a lambda or
+        comprehension in it) is replaced by a stub.
+        """
+        if not self.isolate:
+            render(*args)
+            return
+        error = self.ERROR
+        body, exc = self.capture(render, *args)
+        if exc is None and self.ERROR is error:
+            self.write_body(body)
+            return
+        if exc is None:
+            exc = self.ERROR
+            self.ERROR = error
+        elif issubclass(exc[0], Exception) and not issubclass(exc[0], MemoryError):
+            exc = exc[1]
+        else:
+            raise exc[0], exc[1], exc[2]
+        self.write_stub(co, exc)
+
+    def write_stub(self, co, exc):
+        """Write a body for code object 'co' whose decompilation raised 'exc'."""
+        if isinstance(exc, ParserError):
+            reason = 'parse error at offset %s' % exc.error.offset
+        elif isinstance(exc, CodeTimeout):
+            reason = 'time budget of %gs exceeded' % self.budget
+        else:
+            reason = '%s: %s' % (exc.__class__.__name__,
+                                 (str(exc).splitlines() or [''])[0])
+        self.stubs.append((co.co_name, reason))
+        self.print_(self.indent, '# uncompyle2: ', reason)
+        for line in disassemble(co):
+            self.print_(self.indent, '# ', line)
+        if co.co_flags & CO_OPTIMIZED: # a function, not a class body
+            self.print_(self.indent, 'raise NotImplementedError(%r)'
+                        % ('%s could not be decompiled' % co.co_name))
+        else:
+            self.print_(self.indent, 'pass')
+
+    def within_budget(self, func, *args):
+        """
+        Return func(*args); raise CodeTimeout if it takes longer than
+        budget.  The parser is reset after a timeout, which may have
+        interrupted it anywhere.
+        """
+        if not self.budget or not hasattr(signal, 'setitimer'):
+            return func(*args)
+        try:
+            handler = signal.signal(signal.SIGALRM, _alarm)
+        except ValueError: # not in the main thread
+            return func(*args)
+        signal.setitimer(signal.ITIMER_REAL, self.budget)
+        try:
+            return func(*args)
+        except CodeTimeout:
+            Parser.reset()
+            raise
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, handler)
+
+    def scan_and_parse(self, co, isLambda=0, noneInNames=False):
+        """Return the Code and the AST of a nested code object."""
+        code = self.make_code(co)
+        return code, self.build_ast(code._tokens, code._customize,
+                                    isLambda=isLambda, noneInNames=noneInNames,
+                                    name=co.co_name)
+
+    def make_code(self, co):
+        """Disassemble a nested code object into a Code."""
+        if self.stats is None and self.profiler is None:
+            return Code(co, self.scanner, self.currentclass)
+        t = time.time()
+        if self.profiler is not None:
+            self.profiler.enter('scan')
+        try:
+            code = Code(co, self.scanner, self.currentclass)
+        finally:
+            if self.profiler is not None:
+                self.profiler.leave()
+        if self.stats is not None:
+            self.stats['scan'] = self.stats.get('scan', 0) + time.time() - t
+        return code
+
+    def parse(self, tokens, customize, name=None):
+        """
+        Parser.parse() plus accounting, see __init__(), and the hooks
+        of code object 'name'.
+        """
+        if self.stats is None and self.profiler is None:
+            if hooks.callbacks:
+                return hooks.call('parse', name, len(tokens), Parser.parse,
+                                  tokens, customize)
+            return Parser.parse(tokens, customize)
+        t = time.time()
+        if self.profiler is not None:
+            self.profiler.enter('parse')
+        try:
+            if hooks.callbacks:
+                ast = hooks.call('parse', name, len(tokens), Parser.parse,
+                                 tokens, customize)
+            else:
+                ast = Parser.parse(tokens, customize)
+        finally:
+            if self.profiler is not None:
+                self.profiler.leave()
+            stats = self.stats
+            if stats is not None:
+                stats['parse'] = stats.get('parse', 0) + time.time() - t
+                stats['tokens'] = stats.get('tokens', 0) + len(tokens)
+        if stats is not None:
+            stats['nodes'] = stats.get('nodes', 0) + count_nodes(ast)
+        return ast
+
+    def gen_source(self, ast, customize, isLambda=0, returnNone=False,
+                   name=None):
         """convert AST to source code"""
+        if hooks.callbacks:
+            return hooks.call('gen_source', name, count_nodes(ast),
+                              self._gen_source, ast, customize, isLambda,
+                              returnNone)
+        return self._gen_source(ast, customize, isLambda, returnNone)
 
+    def _gen_source(self, ast, customize, isLambda=0, returnNone=False):
         rn = self.return_none
         self.return_none = returnNone
         # if code would be empty, append 'pass'
@@ -1406,14 +1833,15 @@ class Walker(GenericASTTraversal, object):
                 self.print_(self.traverse(ast, isLambda=isLambda))            
         self.return_none = rn
 
-    def build_ast(self, tokens, customize, isLambda=0, noneInNames=False):
+    def build_ast(self, tokens, customize, isLambda=0, noneInNames=False,
+                  name=None):
         assert type(tokens) == ListType
         assert isinstance(tokens[0], Token)
         
         if isLambda:
             tokens.append(Token('LAMBDA_MARKER'))
             try:
-                ast = Parser.parse(tokens, customize)
+                ast = self.parse(tokens, customize, name)
             except Parser.ParserError, e:
                 raise ParserError(e, tokens)
             if self.showast:
@@ -1431,7 +1859,7 @@ class Walker(GenericASTTraversal, object):
             
         # Build AST from disassembly.
         try:
-            ast = Parser.parse(tokens, customize)
+            ast = self.parse(tokens, customize, name)
         except Parser.ParserError, e:
             raise ParserError(e, tokens)
 
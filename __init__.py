@@ -26,46 +26,77 @@
 #     Probably a complete rewrite would be sensefull. hG/2000-12-27
 #
 
-import sys, types, os
-import Scanner, Walker, verify, magics
+import sys, types, os, time, zipfile
+import Scanner, Walker, verify, magics, manifest, supervisor, archive
+import progress, reports, shards, journal, profiling, hooks
+
+__version__ = '1.1'
 
 sys.setrecursionlimit(5000)
-__all__ = ['uncompyle_file', 'uncompyle_file', 'main']
+__all__ = ['uncompyle_file', 'uncompyle_file', 'main', 'decompile',
+           'decompile_iter']
 
-def _load_file(filename):
+def _load_file(filename, source=None):
     """
     load a Python source file and compile it to byte-code
 
-    _load_module(filename: string): code_object
+    _load_module(filename: string[, source: string]): code_object
 
     filename:	name of file containing Python source code
     		(normally a .py)
+    source:	if given, the source code itself; 'filename' is
+    		only used for messages then
     code_object: code_object compiled from this source code
 
     This function does NOT write any file!
     """
-    fp = open(filename, 'rb')
-    source = fp.read()+'\n'
+    if source is None:
+        fp = open(filename, 'rb')
+        source = fp.read()
+        fp.close()
+    source = source + '\n'
     try:
         co = compile(source, filename, 'exec')
     except SyntaxError:
         print >> sys.stderr, '>>Syntax error in', filename
         raise
-    fp.close()
     return co
 
-def _load_module(filename):
+def _load_module(filename, member=None):
     """
     load a module without importing it
-    _load_module(filename: string): code_object
+    _load_module(filename: string[, member: string]): code_object
 
     filename:	name of file containing Python byte-code object
     		(normally a .pyc)
+    member:	if given, 'filename' is a zip archive (.zip, .egg, .whl)
+    		and the byte-code is read from this member of it
     code_object: code_object from this file
     """
+    if member is None:
+        fp = open(filename, 'rb')
+        data = fp.read()
+        fp.close()
+    else:
+        data = archive.read_member(filename, member)
+        filename = '%s/%s' % (filename, member)
+    return _load_data(data, filename)
+
+def _load_data(data, filename='<data>'):
+    """
+    load a module from the contents of a byte-code file
+    _load_data(data: string[, filename: string]): version, code_object
+
+    filename is only used for messages
+    """
+    if hooks.callbacks:
+        return hooks.call('load', filename, len(data), _unmarshal, data,
+                          filename)
+    return _unmarshal(data, filename)
+
+def _unmarshal(data, filename):
     import magics, marshal
-    fp = open(filename, 'rb')
-    magic = fp.read(4)
+    magic = data[:4]
     try:
         version = magics.versions[magic]
     except KeyError:
@@ -73,16 +104,66 @@ def _load_module(filename):
     if version != '2.7':
         raise ImportError, "This is a Python %s file! Only Python 2.7 files are supported." % version
     #print version
-    fp.read(4) # timestamp
-    co = marshal.load(fp)
-    fp.close()
+    # data[4:8] is the timestamp
+    co = marshal.loads(data[8:])
     return version, co
 
-def uncompyle(version, co, out=None, showasm=0, showast=0, deob=0):
+# estimated cost of a code object on top of the length of its byte-code
+CODE_OBJECT_COST = 100
+
+def _estimate_cost(filename, member=None):
+    """
+    Estimate the work of decompiling a byte-code file: the lengths of
+    the co_code of all its code objects plus CODE_OBJECT_COST for each.
+    Files which cannot be loaded cost their size.
+    """
+    import marshal
+    if member is None:
+        fp = open(filename, 'rb')
+        data = fp.read()
+        fp.close()
+    else:
+        data = archive.read_member(filename, member)
+    try:
+        stack = [marshal.loads(data[8:])]
+    except Exception:
+        return len(data)
+    cost = 0
+    while stack:
+        co = stack.pop()
+        if not isinstance(co, types.CodeType):
+            return len(data)
+        cost += len(co.co_code) + CODE_OBJECT_COST
+        stack.extend(c for c in co.co_consts if isinstance(c, types.CodeType))
+    return cost
+
+def uncompyle(version, co, out=None, showasm=0, showast=0, deob=0, stats=None,
+              isolate=0, budget=None, workers=1, profile=None):
     """
     diassembles a given code block 'co'
+
+    With isolate, a function or class which can't be decompiled, or with
+    budget (seconds) one whose scanning and parsing takes longer, is
+    written as a stub holding its disassembly instead of failing the
+    whole module.  Returns the list of (name, reason) of the stubs.
+
+    With workers > 1, the innermost functions and classes are rendered
+    by that many processes first (see _prefill()); None means one per
+    CPU.  The output is the same.
+
+    If 'stats' is a dict, the seconds spent in the 'scan', 'parse' and
+    'emit' stages and the number of 'tokens' and AST 'nodes' are added
+    to its items of these names, for nested code objects, too.
+
+    If 'profile' is a profiling.StageProfiler, these stages are recorded
+    into its profiles of the same names.  Nothing is rendered by other
+    processes then.
     """
     assert type(co) == types.CodeType
+    if stats is not None:
+        for key in ('scan', 'parse', 'emit', 'tokens', 'nodes'):
+            stats.setdefault(key, 0)
+        t = time.time()
 
     # store final output stream for case of error
     __real_out = out or sys.stdout
@@ -90,12 +171,21 @@ def uncompyle(version, co, out=None, showasm=0, showast=0, deob=0):
         print >>__real_out, '#Embedded file name: %s' % co.co_filename
     scanner = Scanner.getscanner(version)
     scanner.setShowAsm(showasm, out)
-    tokens, customize = scanner.disassemble(co, deob=deob)
+    if profile is not None:
+        profile.enter('scan')
+    try:
+        tokens, customize = scanner.disassemble(co, deob=deob)
+    finally:
+        if profile is not None:
+            profile.leave()
+    if stats is not None:
+        stats['scan'] += time.time() - t
 
     #  Build AST from disassembly.
-    walker = Walker.Walker(out, scanner, showast=showast)
+    walker = Walker.Walker(out, scanner, showast=showast, stats=stats,
+                           isolate=isolate, budget=budget, profiler=profile)
     try:
-        ast = walker.build_ast(tokens, customize)
+        ast = walker.build_ast(tokens, customize, name=co.co_name)
     except Walker.ParserError, e :  # parser failed, dump disassembly
         print >>__real_out, e
         raise
@@ -114,57 +204,741 @@ def uncompyle(version, co, out=None, showasm=0, showast=0, deob=0):
     except:
         pass
     walker.mod_globs = Walker.find_globals(ast, set())
-    walker.gen_source(ast, customize)
+    if workers != 1 and not (showasm or showast or profile):
+        _prefill(walker, co, version, workers)
+    if stats is not None:
+        # gen_source() scans and parses all nested code objects
+        t = time.time() - stats['scan'] - stats['parse']
+    if profile is not None:
+        profile.enter('emit')
+    try:
+        walker.gen_source(ast, customize, name=co.co_name)
+    finally:
+        if profile is not None:
+            profile.leave()
     for g in walker.mod_globs:
         walker.write('global %s ## Warning: Unused global\n' % g)
     if walker.pending_newlines:
         print >>__real_out
+    if stats is not None:
+        stats['emit'] += time.time() - stats['scan'] - stats['parse'] - t
     if walker.ERROR:
         raise walker.ERROR
+    return walker.stubs
 
-def uncompyle_file(filename, outstream=None, showasm=0, showast=0, deob=0):
+def uncompyle_file(filename, outstream=None, showasm=0, showast=0, deob=0,
+                   member=None, workers=1):
     """
-    decompile Python byte-code file (.pyc)
+    decompile Python byte-code file (.pyc) or the member 'member' of
+    the zip archive 'filename'
     """
-    version, co = _load_module(filename)
-    uncompyle(version, co, outstream, showasm, showast, deob)
+    version, co = _load_module(filename, member)
+    uncompyle(version, co, outstream, showasm, showast, deob, workers=workers)
     co = None
 
+def _leaf_code(co, classname=None):
+    """
+    Yield (code object, class name) for the functions and classes in
+    code object 'co' which hold no functions or classes themselves.
+    The class name is the walker's currentclass for its body.
+    """
+    for c in co.co_consts:
+        if type(c) != types.CodeType or c.co_name.startswith('<'):
+            continue # not a code object, a lambda or a comprehension
+        if c.co_flags & Walker.CO_OPTIMIZED:
+            inner = classname
+        else:
+            inner = c.co_name # a class body
+        leaves = list(_leaf_code(c, inner))
+        if leaves:
+            for leaf in leaves:
+                yield leaf
+        else:
+            yield c, inner
+
+def _render_body(job):
+    # Walker.render_body() on behalf of _prefill(), in a worker process
+    import marshal
+    from cStringIO import StringIO
+    version, data, classname, mod_globs, isolate, budget = job
+    scanner = Scanner.getscanner(version)
+    scanner.setShowAsm(0)
+    walker = Walker.Walker(StringIO(), scanner, isolate=isolate, budget=budget)
+    walker.currentclass = classname
+    walker.mod_globs = set(mod_globs)
+    try:
+        key = walker.render_body(marshal.loads(data))
+    except Exception:
+        return None # make_function() or build_class() will report it
+    body = key and Walker.body_cache.entries.get(key)
+    return body and (key, body)
+
+def _prefill(walker, co, version, workers):
+    """
+    Render the bodies of the innermost functions and classes of module
+    'co' in 'workers' processes, largest first, and put them into
+    Walker.body_cache, where walker takes them from.  Those with
+    functions or classes in them are left to walker.
+    """
+    import multiprocessing, marshal
+    if not Walker.body_cache.maxsize or hooks.callbacks \
+           or multiprocessing.current_process().daemon: # no children
+        return
+    leaves = sorted(_leaf_code(co), key=lambda leaf: len(leaf[0].co_code),
+                    reverse=True)
+    if len(leaves) < 2:
+        return
+    mod_globs = sorted(walker.mod_globs)
+    jobs = ((version, marshal.dumps(c), classname, mod_globs,
+             walker.isolate, walker.budget) for c, classname in leaves)
+    for result in _imap(_render_body, jobs, workers, ordered=False):
+        if result:
+            Walker.body_cache.put(*result)
+
+#---- in memory -------
+
+def _error_info(e):
+    # describe exception 'e', which is being handled
+    import traceback
+    error = {'type': e.__class__.__name__, 'message': str(e)}
+    if isinstance(e, Walker.ParserError):
+        error['offset'] = str(e.error.offset)
+    else:
+        error['traceback'] = traceback.format_exc()
+    return error
+
+def decompile(obj, showasm=0, showast=0, deob=0, do_verify=0, stats=None,
+              isolate=0, budget=None, workers=1):
+    """
+    decompile the contents of a byte-code file (a string) or a code
+    object, without any files or streams
+
+    Returns a dict with
+      status	'ok', 'failed', 'unverified' or 'partial' (some
+      		functions or classes are stubs)
+      source	the source code (partial if the decompilation failed)
+      stubs	list of (name, reason) of the stubs
+      error	None or a dict with the 'type' and 'message' of the
+      		exception and the 'offset' of a ParserError or else the
+      		'traceback'
+      time	seconds taken
+
+    'stats', 'isolate', 'budget' and 'workers' are passed on to
+    uncompyle().
+    """
+    from cStringIO import StringIO
+    t = time.time()
+    out = StringIO()
+    result = {'status': 'ok', 'error': None, 'stubs': []}
+    try:
+        if isinstance(obj, types.CodeType):
+            version, co = '2.7', obj
+        else:
+            version, co = _load_data(obj)
+        stubs = result['stubs'] = uncompyle(version, co, out, showasm, showast,
+                                            deob, stats, isolate, budget,
+                                            workers)
+        if stubs:
+            result['status'] = 'partial' # would not verify
+        elif do_verify:
+            try:
+                verify.cmp_code_objects(version, co,
+                                        _load_file('<source>', out.getvalue()))
+            except verify.VerifyCmpError, e:
+                result['status'] = 'unverified'
+                result['error'] = _error_info(e)
+    except KeyboardInterrupt:
+        raise
+    except Exception, e:
+        result['status'] = 'failed'
+        result['error'] = _error_info(e)
+    result['source'] = out.getvalue()
+    result['time'] = round(time.time() - t, 6)
+    return result
+
+def _decompile_item(item):
+    # decompile() on behalf of decompile_iter()
+    index, obj, options = item
+    if options['code']:
+        import marshal
+        obj = marshal.loads(obj)
+    return index, decompile(obj, deob=options['deob'],
+                            do_verify=options['do_verify'],
+                            isolate=options['isolate'],
+                            budget=options['budget'])
+
+def _decompile_killed(item, reason):
+    return item[0], {'status': reason, 'source': '', 'time': None, 'stubs': [],
+                     'error': {'type': 'WorkerKilled', 'message': reason}}
+
+def decompile_iter(iterable, workers=None, deob=0, do_verify=0,
+                   timeout=None, maxrss=None, isolate=0, budget=None):
+    """
+    decompile() each item of 'iterable' in 'workers' processes
+
+    Yields (index, result) pairs as soon as an item is done, where index
+    is the position of the item in iterable.  With a timeout (seconds)
+    or maxrss (megabytes), an item exceeding it gets the status 'timeout'
+    or 'oom' (see main()).  iterable is consumed lazily.
+    """
+    def items():
+        import marshal
+        for index, obj in enumerate(iterable):
+            options = {'deob': deob, 'do_verify': do_verify,
+                       'isolate': isolate, 'budget': budget,
+                       'code': isinstance(obj, types.CodeType)}
+            if options['code']:
+                obj = marshal.dumps(obj) # code objects can't be pickled
+            yield index, obj, options
+    return _imap(_decompile_item, items(), workers, timeout, maxrss,
+                 _decompile_killed, ordered=False)
+
 #---- main -------
 
-if sys.platform.startswith('linux') and os.uname()[2][:2] == '2.':
-    def __memUsage():
-        mi = open('/proc/self/stat', 'r')
-        mu = mi.readline().split()[22]
-        mi.close()
-        return int(mu) / 1000000
-else:
-    def __memUsage():
-        return ''
+def __memUsage():
+    # peak RSS in MB; not available everywhere
+    return progress.peak_rss() / 1000000 or ''
+
+# suffixes appended to the names of output files which are not okay
+FAILED_SUFFIXES = ('_failed', '_unverified', '_timeout', '_oom', '_partial')
+
+def _prepare_outfile(outfile):
+    # remove the output of earlier runs, make the directory
+    dir = os.path.dirname(outfile)
+    for suffix in FAILED_SUFFIXES:
+        failed_file = outfile + suffix
+        if os.path.exists(failed_file): os.remove(failed_file)
+    try:
+        os.makedirs(dir)
+    except OSError:
+        pass
+
+def _final_outfile(outfile, status):
+    # the name of the output file once the result is 'status'
+    if outfile and status not in (None, 'ok'):
+        return '%s_%s' % (outfile, status)
+    return outfile
+
+def _get_outstream(outfile):
+    _prepare_outfile(outfile)
+    return open(outfile, 'w')
+
+def _uncompyle_job(job):
+    """
+    decompile a single file on behalf of main()
+
+    job is a dict with the keys 'infile', 'outfile', 'file' and
+    'options' (a dict of main()'s showasm, showast, do_verify, deob,
+    incremental, retry, isolate, budget, module_workers, profile and
+    profile_threshold arguments and 'timings').  If infile is a zip archive,
+    'member' names the byte-code file in it.  For incremental runs the
+    job also holds 'previous', the (digest, status) pair recorded in the
+    manifest.  When resuming a run, 'finished' is the (status, output
+    digest, recheck) entry of the journal.  When outfile is None the
+    source is collected in memory and returned instead of being written;
+    'arcname' then names the source for verification.
+
+    Returns a dict with
+      file	job['file']
+      outfile	name of the output file (with a _failed, ... suffix) or None
+      arcname	job['arcname'], if any
+      status	'ok', 'failed', 'unverified', 'partial' (some functions
+      		or classes are stubs) or 'oom' (MemoryError)
+      skipped	true if the file is unchanged or was finished by the
+      		run being resumed and was not decompiled
+      source	decompiled source if outfile is None (partial if the
+      		decompilation failed)
+      digest	content hash of the input file (incremental runs only)
+      insize	size of the input file in bytes
+      maxrss	peak RSS of the worker process in bytes
+      weight	job['weight'] (see main())
+      outsize	size of the output in bytes
+      stats	if options['timings']: seconds spent in the stages
+      		'load', 'scan', 'parse', 'emit', 'verify' and in 'total',
+      		number of 'tokens' and AST 'nodes' (see uncompyle())
+      profile	the profile dumps of the file by stage, if profiled
+      		(see _profile_job())
+      log	list of (stream, message) pairs
+    No output is printed here, so that the caller can replay the log in
+    input order regardless of which worker process finished first.
+    """
+    import traceback
+    infile, outfile, file = job['infile'], job['outfile'], job['file']
+    co = profiler = seconds = None
+    member = job.get('member')
+    opts = job['options']
+    if member:
+        infile = '%s/%s' % (infile, member) # for the messages only
+    log = []
+    result = {'file': file, 'status': None, 'skipped': False,
+              'source': None, 'digest': None, 'log': log,
+              'arcname': job.get('arcname'), 'weight': job['weight'],
+              'maxrss': None, 'outsize': None, 'stats': None,
+              'profile': None}
+    stats = None
+    if opts['timings']:
+        stats = result['stats'] = {'load': 0, 'verify': 0}
+    start = time.time()
+    # None if the input can't be read; loading it fails again below
+    result['insize'] = _input_size(job['infile'], member)
+    if opts['incremental']:
+        result['digest'] = _input_digest(job['infile'], member)
+
+    try:
+        finished = job.get('finished')
+        if finished:
+            status, outdigest, recheck = finished
+            done = _final_outfile(outfile, status)
+            if os.path.exists(done) and \
+                   (not recheck or journal.output_digest(done) == outdigest):
+                result['status'] = status
+                result['skipped'] = True
+                log.append(('stdout', "--- skipping finished %s (%s)\n" % (infile, status)))
+                return result
+
+        if opts['incremental']:
+            digest = result['digest']
+            previous = job.get('previous')
+            if previous and digest is not None and previous[0] == digest \
+                   and (previous[1] == 'ok' or not opts['retry']):
+                status = previous[1]
+                done = _final_outfile(outfile, status)
+                if os.path.exists(done):
+                    result['status'] = status
+                    result['skipped'] = True
+                    log.append(('stdout', "--- skipping unchanged %s (%s)\n" % (infile, status)))
+                    return result
+
+        if outfile:
+            outstream = _get_outstream(outfile)
+        else:
+            from cStringIO import StringIO
+            outstream = StringIO()
+
+        # try to decomyple the input file
+        try:
+            t = time.time()
+            version, co = _load_module(job['infile'], member)
+            if stats is not None:
+                stats['load'] = time.time() - t
+            if opts['profile'] and not opts['profile_threshold']:
+                profiler = profiling.StageProfiler()
+            t = time.time()
+            try:
+                stubs = uncompyle(version, co, outstream, opts['showasm'],
+                                  opts['showast'], opts['deob'], stats,
+                                  opts['isolate'], opts['budget'],
+                                  opts['module_workers'], profiler)
+            finally:
+                seconds = time.time() - t
+        except KeyboardInterrupt:
+            if outfile:
+                outstream.close()
+                os.remove(outfile)
+            raise
+        except MemoryError:
+            if outfile:
+                outstream.close()
+                os.rename(outfile, outfile + '_oom')
+            log.append(('stderr', "### Out of memory uncompyling %s\n" % infile))
+            result['status'] = 'oom'
+            return result
+        except:
+            log.append(('stderr', "### Can't uncompyle %s\n" % infile))
+            if outfile:
+                outstream.close()
+                result['outsize'] = os.path.getsize(outfile)
+                os.rename(outfile, outfile + '_failed')
+            else:
+                result['source'] = outstream.getvalue()
+                result['outsize'] = len(result['source'])
+            log.append(('stderr', traceback.format_exc()))
+            result['status'] = 'failed'
+            return result
+
+        # uncompyle successfull
+        if outfile:
+            outstream.close()
+            result['outsize'] = os.path.getsize(outfile)
+        else:
+            result['source'] = outstream.getvalue()
+            result['outsize'] = len(result['source'])
+        if stubs:
+            if outfile:
+                os.rename(outfile, outfile + '_partial')
+            log.append(('stderr', "### Partially uncompyled %s\n" % infile))
+            for name, reason in stubs:
+                log.append(('stderr', "    %s: %s\n" % (name, reason)))
+            result['status'] = 'partial'
+            return result
+        if opts['do_verify']:
+            t = time.time()
+            try:
+                # compare with the code object loaded above, no need to read
+                # the byte-code again
+                if outfile:
+                    src_co = _load_file(outfile)
+                else:
+                    src_co = _load_file(job.get('arcname') or '<stdout>',
+                                        result['source'])
+                verify.cmp_code_objects(version, co, src_co)
+            except verify.VerifyCmpError, e:
+                if stats is not None:
+                    stats['verify'] = time.time() - t
+                if outfile:
+                    os.rename(outfile, outfile + '_unverified')
+                log.append(('stderr', "### Error Verifiying %s\n%s\n" % (file, e)))
+                result['status'] = 'unverified'
+                return result
+            if stats is not None:
+                stats['verify'] = time.time() - t
+        log.append(('stdout', "+++ okay decompyling %s %s\n" % (infile, __memUsage())))
+        result['status'] = 'ok'
+        return result
+    finally:
+        result['outfile'] = _final_outfile(outfile, result['status'])
+        if opts['profile'] and seconds is not None \
+               and result['status'] not in (None, 'oom'):
+            result['profile'] = _profile_job(job, version, co, profiler,
+                                             seconds)
+        result['maxrss'] = progress.peak_rss()
+        if stats is not None:
+            stats['total'] = time.time() - start
+
+def _profile_job(job, version, co, profiler, seconds):
+    """
+    Write the profile of a file decompiled by _uncompyle_job() below
+    main()'s profile directory, return the dumps by stage (see
+    profiling.py).  Without 'profiler', the file is only profiled if
+    decompiling it took profile_threshold 'seconds' or longer; it is
+    decompiled once more for that, bypassing Walker.body_cache, which
+    the first time filled with its bodies.
+    """
+    opts = job['options']
+    if profiler is None:
+        if seconds < opts['profile_threshold']:
+            return None
+        from cStringIO import StringIO
+        profiler = profiling.StageProfiler()
+        cache_size = Walker.body_cache.maxsize
+        Walker.body_cache.maxsize = 0 # neither used nor filled
+        try:
+            uncompyle(version, co, StringIO(), deob=opts['deob'],
+                      isolate=opts['isolate'], budget=opts['budget'],
+                      profile=profiler)
+        except Exception:
+            pass # failed again; the profile shows how far it got
+        finally:
+            Walker.body_cache.maxsize = cache_size
+    return profiler.dump(os.path.join(opts['profile'], job['file']))
+
+# what reading an input file or archive member raises
+_READ_ERRORS = (EnvironmentError, KeyError, zipfile.BadZipfile)
+
+def _input_size(filename, member=None):
+    """Return the size of an input file or member, None if it can't be read."""
+    try:
+        if member:
+            return archive.member_size(filename, member)
+        return os.path.getsize(filename)
+    except _READ_ERRORS:
+        return None
+
+def _input_digest(filename, member=None):
+    """
+    Return manifest.file_digest() of an input file or member, None if it
+    can't be read.
+    """
+    try:
+        return manifest.file_digest(filename, member)
+    except _READ_ERRORS:
+        return None
+
+def _killed_job(job, reason):
+    """
+    Return the result of a job whose worker process was killed: 'reason'
+    is 'timeout' or 'oom' (see supervisor.imap()), which becomes its
+    status.  A worker which crashed on its own counts as 'failed'.
+    """
+    infile, outfile = job['infile'], job['outfile']
+    member = job.get('member')
+    if reason not in ('timeout', 'oom'):
+        reason = 'failed'
+    result = {'file': job['file'], 'status': reason, 'skipped': False,
+              'source': None, 'digest': None, 'arcname': job.get('arcname'),
+              'weight': job['weight'], 'insize': None, 'maxrss': None,
+              'outsize': None, 'stats': None,
+              'log': [('stderr', "### Can't uncompyle %s: worker killed (%s)\n"
+                       % (member and '%s/%s' % (infile, member) or infile,
+                          reason))]}
+    if job['options']['incremental']:
+        result['digest'] = _input_digest(infile, member)
+    result['insize'] = _input_size(infile, member)
+    if outfile:
+        if not os.path.exists(outfile): # killed before it got that far
+            _get_outstream(outfile).close()
+        os.rename(outfile, '%s_%s' % (outfile, reason))
+    result['outfile'] = _final_outfile(outfile, reason)
+    return result
+
+def _payload_digest(filename, member=None):
+    """
+    Return the SHA-1 hex digest of a byte-code file without the
+    modification time in its header, which _load_data() skips, too.
+    """
+    import hashlib
+    if member is None:
+        fp = open(filename, 'rb')
+        data = fp.read()
+        fp.close()
+    else:
+        data = archive.read_member(filename, member)
+    return hashlib.sha1(data[:4] + data[8:]).hexdigest()
+
+def _copy_result(result, job, primary):
+    """
+    Return the result for 'job', a duplicate of the job 'primary' whose
+    result is 'result'.  An output file of 'primary' is hard linked (or
+    copied) to the output file of 'job'.
+    """
+    status = result['status']
+    infile, outfile = job['infile'], job['outfile']
+    member = job.get('member')
+    if member:
+        infile = '%s/%s' % (infile, member) # for the messages only
+    copy = dict(result, file=job['file'], arcname=job.get('arcname'),
+                weight=job['weight'], skipped=False, stats=None,
+                profile=None, duplicate_of=primary['file'])
+    if job['options']['incremental']:
+        copy['digest'] = _input_digest(job['infile'], member)
+    copy['outfile'] = dst = _final_outfile(outfile, status)
+    src = result['outfile']
+    if dst and dst != src:
+        _prepare_outfile(outfile)
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        try:
+            os.link(src, dst)
+        except (AttributeError, OSError): # no os.link() on win32
+            import shutil
+            shutil.copyfile(src, dst)
+    if status == 'ok':
+        copy['log'] = [('stdout', "+++ okay decompyling %s (same as %s)\n"
+                        % (infile, primary['file']))]
+    else:
+        copy['log'] = [('stderr', "### Can't uncompyle %s (same as %s, %s)\n"
+                        % (infile, primary['file'], status))]
+    return copy
+
+def _write_log(log, stdout=None):
+    for stream, msg in log:
+        if stream == 'stdout' and stdout is not None:
+            stdout.write(msg)
+        else:
+            getattr(sys, stream).write(msg)
+
+# get() without a timeout can not be interrupted by Ctrl-C
+_FOREVER = 0x7fffffff
+
+def _get(result, idle=None):
+    """Return the value of AsyncResult 'result', calling idle() while waiting."""
+    if idle:
+        while not result.ready():
+            result.wait(supervisor.TICK)
+            idle()
+    return result.get(_FOREVER)
+
+def _ready(pending, idle=None):
+    """Remove the finished AsyncResults from deque 'pending', return their values."""
+    pending[0].wait(supervisor.TICK)
+    if idle:
+        idle()
+    done = [r for r in pending if r.ready()]
+    for r in done:
+        pending.remove(r)
+    return [r.get(_FOREVER) for r in done]
+
+def _imap(func, iterable, workers=1, timeout=None, maxrss=None, killed=None,
+          ordered=True, idle=None):
+    """
+    Apply func to each item of iterable, yielding the results in input
+    order, or in the order they are ready if not 'ordered'.  Only the
+    latter keeps all workers busy when an early item takes much longer
+    than the items after it.
+
+    With workers > 1 the calls are spread over a pool of that many
+    processes; workers=None means one process per CPU.  func must be a
+    module level function, its arguments and results must be picklable.
+
+    iterable is consumed lazily: only a few items per worker are in
+    flight at any time, so it may be an endless generator.
+
+    If a time limit (seconds) or a memory limit (maxrss, megabytes) is
+    given, each item is processed in a supervised worker, even if
+    workers is 1, and killed(item, reason) provides the result for items
+    exceeding them (see supervisor.imap()).
+
+    If given, idle() is called regularly while waiting for the workers,
+    but not between the items of a single process.
+    """
+    if workers is None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+    if timeout or maxrss:
+        if maxrss:
+            maxrss = maxrss * 1024 * 1024 # supervisor counts bytes
+        for result in supervisor.imap(func, iterable, workers, timeout,
+                                      maxrss, killed, ordered, idle):
+            yield result
+        return
+    if workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    import multiprocessing
+    from collections import deque
+    pool = multiprocessing.Pool(workers)
+    pending = deque()
+    window = 4 * workers
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item,)))
+            if not ordered:
+                while len(pending) >= window:
+                    for result in _ready(pending, idle):
+                        yield result
+                continue
+            # wait for the oldest one only: pathological files must
+            # not hold back the others more than the window requires
+            while len(pending) >= window or (pending and pending[0].ready()):
+                yield _get(pending.popleft(), idle)
+        while pending:
+            if ordered:
+                yield _get(pending.popleft(), idle)
+            else:
+                for result in _ready(pending, idle):
+                    yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 def main(in_base, out_base, files, codes, outfile=None,
-         showasm=0, showast=0, do_verify=0, py=0, deob=0):
+         showasm=0, showast=0, do_verify=0, py=0, deob=0, workers=None,
+         incremental=0, retry=0, timeout=None, maxrss=None, outarchive=None,
+         progress_format=None, progress_interval=2.0, report=None,
+         shard=None, largest_first=0, dedup=0, checkpoint=0, resume=0,
+         isolate=0, budget=None, module_workers=1, profile=None,
+         profile_threshold=0):
     """
     in_base	base directory for input files
     out_base	base directory for output files (ignored when
     files	list of filenames to be uncompyled (relative to src_base)
     outfile	write output to this filename (overwrites out_base)
+    workers	number of worker processes (None: one per CPU)
+    incremental	skip files which did not change since the last run
+    retry	with incremental: retry failed and unverified files, too
+    timeout	seconds a single file may take
+    maxrss	megabytes of memory the decompilation of a file may use
+    outarchive	write all output into this tar or zip archive ('-' for
+    		a tar stream on stdout; overwrites out_base)
+    progress_format
+    		report progress to stderr: 'text' or 'json' (one JSON
+    		object per line, for machines); None for no reports
+    progress_interval
+    		seconds between two progress reports
+    report	write a JSON line per input with its status, sizes and
+    		stage timings to this file (see reports.py)
+    shard	decompile only shard 'i/n' of 'files' (see shards.py)
+    largest_first
+    		start the most expensive files first (see below)
+    dedup	decompile byte-identical inputs only once (see below)
+    checkpoint	keep a journal of the finished files (see below)
+    resume	skip the files finished by an earlier run which died
+    		(implies checkpoint)
+    isolate	write functions and classes which can't be decompiled
+    		as stubs (see uncompyle())
+    budget	seconds the scanning and parsing of a single function or
+    		class may take (implies isolate)
+    module_workers
+    		number of processes decompiling the functions of a
+    		single module (see uncompyle()); only with workers=1
+    profile	write cProfile dumps by stage into this directory
+    profile_threshold
+    		profile only files which take this many seconds or longer
 
     For redirecting output to
     - <filename>		outfile=<filename> (out_base is ignored)
+    - one archive		outarchive=<filename> or '-' (out_base is ignored)
     - files below out_base	out_base=...
     - stdout			out_base=None, outfile=None
-    """
-    def _get_outstream(outfile):
-        dir = os.path.dirname(outfile)
-        failed_file = outfile + '_failed'
-        if os.path.exists(failed_file): os.remove(failed_file)
-        try:
-            os.makedirs(dir)
-        except OSError:
-            pass
-        return open(outfile, 'w')
 
+    Output, messages and the returned tallies do not depend on the
+    number of workers: results are reported in the order of 'files'.
+    When writing to a single outfile, files are processed serially.
+
+    A few large files started late keep a parallel run going long after
+    the other workers ran out of work.  With largest_first, the cost of
+    every file is estimated up front from its byte-code (see
+    _estimate_cost()) and the most expensive ones are handed out first.
+    Results are then reported as they complete, so only the tallies and
+    the files below out_base stay independent of the number of workers.
+
+    Incremental runs need out_base.  The content hash and result of each
+    input are recorded in a manifest next to out_base (see manifest.py);
+    unchanged files are counted with their previous result.
+
+    A file which is a zip archive (.zip, .egg, .whl) stands for all the
+    byte-code files in it.  They are read straight from the archive and
+    their output goes to a directory named like the archive, e.g.
+    out_base/lib.egg/pkg/mod.pyc_dis.
+
+    With a timeout or maxrss, every file is decompiled in a supervised
+    worker process, which is killed when the file exceeds the limit.  Its
+    output is then renamed to <outfile>_timeout or <outfile>_oom and the
+    file counts as failed.
+
+    An outarchive holds one member per input, named as the file below
+    out_base would be (including a _failed, _unverified, ... suffix), so
+    that a run creates no files or directories besides the archive.  The
+    format follows the name: .zip, .tar.gz/.tgz, .tar.bz2 or plain tar.
+    Only a few decompiled sources per worker are buffered at a time.
+    Incremental runs are not possible with an outarchive.
+
+    With a shard, the files are partitioned by a hash of their name, so
+    n runs with the shards 1/n .. n/n, e.g. on n machines, decompile
+    each file once.  An incremental shard keeps its own manifest.  Give
+    each shard a report; shards.merge() then combines the reports into
+    the tallies of the whole run and the manifests into one.
+
+    With dedup, all inputs are hashed up front, ignoring the modification
+    time in the header of a .pyc file.  Only the first of several equal
+    inputs is decompiled.  The others get the same status and a hard
+    link to its output (a copy where links are not possible), and are
+    reported right after it.  Not possible with an outfile.
+
+    With checkpoint, every file finished below out_base is recorded in
+    the journal <out_base>.journal (see journal.py), which is removed
+    when the run completes.  If a run dies, e.g. killed by the OOM
+    killer, a run with resume and the same arguments skips the files
+    recorded there and decompiles the rest.
+
+    With isolate, a function or class which fails is written as a stub
+    holding its disassembly, and the rest of the module is decompiled.
+    Such a file gets the status 'partial': it counts as failed, but its
+    output, <outfile>_partial, is complete apart from the stubs.
+
+    With profile, the scanning, parsing and emitting of each file is
+    profiled, and the dumps are written to <profile>/<file>.<stage>.prof
+    and, added up over the files, to <profile>/all.<stage>.prof (see
+    profiling.py).  Profiling slows decompiling down.  With a
+    profile_threshold, files are decompiled without the profiler and
+    only those which took the threshold or longer are decompiled once
+    more under it.
+    """
     of = outfile
 
     tot_files = okay_files = failed_files = verify_failed_files = 0
@@ -175,55 +949,174 @@ def main(in_base, out_base, files, codes, outfile=None,
             co = compile(f.read(), "", "exec")
         uncompyle(sys.version[:3], co, sys.stdout, showasm=showasm, showast=showast, deob=deob)
 
-    for file in files:
-        infile = os.path.join(in_base, file)
-        #print >>sys.stderr, infile
+    if of:
+        outarchive = None
+    if of or outarchive or out_base is None:
+        incremental = 0
+    options = {'showasm': showasm, 'showast': showast,
+               'do_verify': do_verify, 'deob': deob,
+               'incremental': incremental, 'retry': retry,
+               'isolate': isolate, 'budget': budget,
+               'module_workers': module_workers,
+               'profile': profile, 'profile_threshold': profile_threshold,
+               'timings': bool(report)}
+    if shard:
+        files = shards.select(files, shard)
+    # the options the output depends on, for the manifest and the journal
+    tag = '%s py=%d deob=%d verify=%d' % (__version__, bool(py),
+                                          bool(deob), bool(do_verify))
+    mf = None
+    if incremental:
+        mfname = manifest.manifest_name(out_base)
+        if shard:
+            mfname = shards.shard_name(mfname, shard)
+        mf = manifest.Manifest(mfname, tag)
+    jn = None
+    if (checkpoint or resume) and out_base is not None \
+           and not (of or outarchive):
+        jnname = journal.journal_name(out_base)
+        if shard:
+            jnname = shards.shard_name(jnname, shard)
+        jn = journal.Journal(jnname, tag, resume)
 
+    def _job(infile, file, member=None):
+        if py:
+            name = file[:-1]
+        else:
+            name = file + '_dis'
         if of: # outfile was given as parameter
-            outstream = _get_outstream(outfile)
-        elif out_base is None:
-            outstream = sys.stdout
+            outfile = of
+        elif outarchive or out_base is None:
+            outfile = None
         else:
-            outfile = os.path.join(out_base, file)
-            if py:
-                outfile = outfile[:-1]
+            outfile = os.path.join(out_base, name)
+        job = {'infile': infile, 'outfile': outfile, 'file': file,
+               'options': options, 'weight': 1.0}
+        if outarchive:
+            job['arcname'] = name.replace(os.sep, '/')
+        if member:
+            job['member'] = member
+        if mf:
+            job['previous'] = mf.get(file)
+        if jn:
+            job['finished'] = jn.get(file)
+        return job
+
+    def _jobs():
+        for file in files:
+            infile = os.path.join(in_base, file)
+            if archive.is_archive(infile):
+                members = archive.members(infile)
+                for member in members:
+                    job = _job(infile, os.path.join(file, *member.split('/')),
+                               member)
+                    # an archive counts as one input for the progress
+                    job['weight'] = 1.0 / len(members)
+                    yield job
             else:
-                outfile += '_dis'
-            outstream = _get_outstream(outfile)
-        #print >>sys.stderr, outfile 
+                yield _job(infile, file)
 
-        # try to decomyple the input file
-        try:
-            uncompyle_file(infile, outstream, showasm, showast, deob)
-            tot_files += 1
-        except KeyboardInterrupt:
-            if outfile:
-                outstream.close()
-                os.remove(outfile)
-            raise
-        except:
-            failed_files += 1
-            sys.stderr.write("### Can't uncompyle %s\n" % infile)
-            if outfile:
-                outstream.close()
-                os.rename(outfile, outfile + '_failed')
-            import traceback
-            traceback.print_exc()
-            #raise
-	else: # uncompyle successfull
-            if outfile:
-                outstream.close()
-            if do_verify:
-                try:
-                    verify.compare_code_with_srcfile(infile, outfile)
-                    print "+++ okay decompyling", infile, __memUsage()
-                    okay_files += 1
-                except verify.VerifyCmpError, e:
-                    verify_failed_files += 1
-                    os.rename(outfile, outfile + '_unverified')
-                    print >>sys.stderr, "### Error Verifiying", file
-                    print >>sys.stderr, e
+    if of:
+        workers = 1
+
+    pg = None
+    if progress_format:
+        total = None
+        if hasattr(files, '__len__'):
+            total = len(files)
+        pg = progress.Progress(total, sys.stderr, progress_interval,
+                               progress_format)
+
+    rp = None
+    if report:
+        rp = reports.Report(report)
+
+    out = None
+    msgout = None
+    if outarchive:
+        out = archive.open_output(outarchive)
+        if outarchive == '-':
+            msgout = sys.stderr # keep the tar stream clean
+
+    jobs = _jobs()
+    ordered = True
+    complete = False
+    profiled = []
+    duplicates = {} # file of the first of equal jobs -> [(job, first job)]
+    if dedup and not of:
+        first = {}
+        unique = []
+        for job in jobs:
+            try:
+                digest = _payload_digest(job['infile'], job.get('member'))
+            except EnvironmentError:
+                unique.append(job) # the job itself reports the error
+                continue
+            if digest in first:
+                duplicates[first[digest]['file']].append((job, first[digest]))
             else:
-                okay_files += 1
-                print "+++ okay decompyling", infile, __memUsage()
+                first[digest] = job
+                duplicates[job['file']] = []
+                unique.append(job)
+        jobs = unique
+    if largest_first and workers != 1:
+        jobs = list(jobs)
+        for job in jobs:
+            try:
+                job['cost'] = _estimate_cost(job['infile'], job.get('member'))
+            except EnvironmentError:
+                job['cost'] = 0 # the job itself reports the error
+        jobs.sort(key=lambda job: job['cost'], reverse=True)
+        ordered = False
+
+    try:
+        idle = pg and pg.tick # refresh while a slow file holds up the results
+        for result in _imap(_uncompyle_job, jobs, workers,
+                            timeout, maxrss, _killed_job, ordered, idle):
+            results = [result]
+            for job, primary in duplicates.pop(result['file'], ()):
+                results.append(_copy_result(result, job, primary))
+            for result in results:
+                status = result['status']
+                if out:
+                    name = result['arcname']
+                    if status != 'ok':
+                        name = '%s_%s' % (name, status)
+                    out.add(name, result['source'] or '')
+                elif result['source'] is not None:
+                    sys.stdout.write(result['source'])
+                _write_log(result['log'], msgout)
+                if pg:
+                    pg.update(result)
+                if rp:
+                    rp.add(result)
+                if mf and result['digest'] is not None:
+                    mf.update(result['file'], result['digest'], status)
+                if jn:
+                    jn.add(result['file'], status,
+                           journal.output_digest(result['outfile']))
+                if result.get('profile'):
+                    profiled.append(result['profile'])
+                if status in ('failed', 'timeout', 'oom', 'partial'):
+                    failed_files += 1
+                    continue
+                tot_files += 1
+                if status == 'unverified':
+                    verify_failed_files += 1
+                else:
+                    okay_files += 1
+        complete = True
+    finally:
+        if rp:
+            rp.close()
+        if out:
+            out.close()
+        if mf:
+            mf.save()
+        if jn:
+            jn.close(remove=complete)
+        if profiled:
+            profiling.aggregate(profiled, os.path.join(profile, 'all'))
+    if pg:
+        pg.report(final=True)
     return (tot_files, okay_files, failed_files, verify_failed_files)
@@ -0,0 +1,99 @@
+#
+# reading byte-code files straight out of zip archives (.zip, .egg, .whl)
+# and writing decompiled sources into a single tar or zip archive
+#
+# Members are read with zipfile, nothing is extracted to disk.
+#
+
+import os, sys, time, zipfile, tarfile
+
+__all__ = ['ARCHIVE_EXTENSIONS', 'is_archive', 'members', 'read_member',
+           'member_size', 'open_output']
+
+ARCHIVE_EXTENSIONS = ('.zip', '.egg', '.whl')
+BYTECODE_EXTENSIONS = ('.pyc', '.pyo')
+
+def is_archive(filename):
+    """Return true if 'filename' is a zip archive which may hold .pyc files."""
+    return os.path.splitext(filename)[1].lower() in ARCHIVE_EXTENSIONS \
+           and os.path.isfile(filename) and zipfile.is_zipfile(filename)
+
+# The archive opened last; its central directory is read only once, even
+# if its members are decompiled one by one.
+__last = [None, None]
+
+def _open(filename):
+    if __last[0] != filename:
+        if __last[1] is not None:
+            __last[1].close()
+        __last[0] = __last[1] = None # don't keep it if opening fails
+        __last[1] = zipfile.ZipFile(filename, 'r')
+        __last[0] = filename
+    return __last[1]
+
+def members(filename):
+    """Return the sorted names of the byte-code files in archive 'filename'."""
+    names = [name for name in _open(filename).namelist()
+             if os.path.splitext(name)[1] in BYTECODE_EXTENSIONS]
+    names.sort()
+    return names
+
+def read_member(filename, member):
+    """Return the contents of 'member' of archive 'filename'."""
+    return _open(filename).read(member)
+
+def member_size(filename, member):
+    """Return the uncompressed size of 'member' of archive 'filename'."""
+    return _open(filename).getinfo(member).file_size
+
+
+class TarOutput:
+    """
+    Write members into a tar stream.  The stream is written sequentially
+    (tarfile's 'w|' mode), so it may be a pipe; nothing but the current
+    member and tarfile's block buffer is kept in memory.
+    """
+    def __init__(self, filename, compression=''):
+        if filename == '-':
+            self.tar = tarfile.open(mode='w|' + compression, fileobj=sys.stdout)
+        else:
+            self.tar = tarfile.open(filename, 'w|' + compression)
+        self.mtime = time.time()
+
+    def add(self, name, data):
+        from cStringIO import StringIO
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = self.mtime
+        info.mode = 0644
+        self.tar.addfile(info, StringIO(data))
+
+    def close(self):
+        self.tar.close()
+
+class ZipOutput:
+    """Write members into a zip file (zip needs a seekable file)."""
+    def __init__(self, filename):
+        self.zip = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED,
+                                   allowZip64=True)
+
+    def add(self, name, data):
+        self.zip.writestr(name, data)
+
+    def close(self):
+        self.zip.close()
+
+def open_output(filename):
+    """
+    Open an output archive; the format follows the name of the file:
+    .zip, .tar.gz/.tgz, .tar.bz2 or else an uncompressed tar.  '-' is a
+    tar stream on stdout.
+    """
+    name = filename.lower()
+    if name.endswith('.zip'):
+        return ZipOutput(filename)
+    elif name.endswith(('.tar.gz', '.tgz')):
+        return TarOutput(filename, 'gz')
+    elif name.endswith(('.tar.bz2', '.tbz2')):
+        return TarOutput(filename, 'bz2')
+    return TarOutput(filename)
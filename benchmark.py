@@ -0,0 +1,370 @@
+#
+# reproducible benchmark of the decompiler stages
+#
+# The corpus is fixed: the modules directly in a source directory (the
+# standard library of the running Python by default), sorted by name,
+# and the synthetic stress modules of STRESS below.  They are compiled
+# to .pyc files with a zero time stamp and a relative file name, so the
+# same sources give byte for byte the same corpus; its digest is part
+# of the results.  Every file is decompiled 'repeat' times with the body
+# cache off, and the fastest run counts for each stage:
+#
+#	load	reading the .pyc file
+#	scan	Scanner.disassemble
+#	parse	Parser.parse
+#	emit	Walker.gen_source
+#	verify	compiling the output and verify.cmp_code_objects
+#
+# The results are written as JSON.  Compared against a baseline, a
+# stage total or the peak RSS which grew by more than its threshold (a
+# fraction, THRESHOLDS by default), or a file which no longer decompiles
+# or verifies, is a regression and makes the exit status 1:
+#
+#	python benchmark.py [-s srcdir] [-n count] [-r repeat] [-c corpus-dir]
+#		[-V] [-o results.json] [-b baseline.json] [-t [stage=]fraction ...]
+#
+
+import os, sys, time, glob, json, marshal, imp, hashlib, shutil, tempfile
+import platform
+from cStringIO import StringIO
+
+import uncompyle2
+from uncompyle2 import Walker, verify, progress
+from uncompyle2.daemon import warm_up
+
+__all__ = ['STRESS', 'THRESHOLDS', 'build_corpus', 'corpus_digest', 'run',
+           'compare']
+
+STAGES = ('load', 'scan', 'parse', 'emit', 'verify')
+
+# how much a stage total or the peak RSS may grow before it is a regression
+THRESHOLDS = dict.fromkeys(STAGES + ('total', 'peak_rss'), 0.10)
+
+def _stress_functions(count=300):
+    """many small functions"""
+    lines = []
+    for i in range(count):
+        lines.append('def f%d(a, b=%d, *args, **kw):' % (i, i))
+        lines.append('    for x in args:')
+        lines.append('        if x > b:')
+        lines.append('            a += x * %d' % i)
+        lines.append('    return a, kw.get(%r)' % ('k%d' % i))
+    return '\n'.join(lines) + '\n'
+
+def _stress_nesting(count=20, depth=16):
+    """deeply nested compound statements"""
+    lines = []
+    for n in range(count):
+        lines.append('def f%d(a, b):' % n)
+        closers = []
+        for i in range(depth):
+            indent = '    ' * (i + 1)
+            kind = i % 4
+            if kind == 0:
+                lines.append(indent + 'if a > %d:' % i)
+                closers.append([indent + 'else:', indent + '    a = -%d' % i])
+            elif kind == 1:
+                lines.append(indent + 'for x%d in b:' % i)
+                closers.append([])
+            elif kind == 2:
+                lines.append(indent + 'while a < %d:' % i)
+                lines.append(indent + '    a += x%d' % (i - 1))
+                closers.append([])
+            else:
+                lines.append(indent + 'try:')
+                closers.append([indent + 'except ValueError:',
+                                indent + '    continue'])
+        lines.append('    ' * (depth + 1) + 'b.append(a)')
+        for closer in reversed(closers):
+            lines.extend(closer)
+        lines.append('    return a')
+    return '\n'.join(lines) + '\n'
+
+def _stress_expressions(terms=400, branches=150):
+    """long expressions and a long elif chain"""
+    lines = ['def f(a, b, c):']
+    lines.append('    x = ' + ' + '.join(['a * %d - b / %d' % (i, i + 1)
+                                          for i in range(terms)]))
+    lines.append('    y = ' + ' or '.join(['a > %d and b < %d' % (i, i)
+                                           for i in range(terms / 4)]))
+    lines.append('    if c == 0:')
+    lines.append('        return x')
+    for i in range(1, branches):
+        lines.append('    elif c == %d:' % i)
+        lines.append('        return x + %d' % i)
+    lines.append('    return y')
+    return '\n'.join(lines) + '\n'
+
+def _stress_literals(count=300):
+    """big literals"""
+    lines = ['D = {']
+    lines.extend(['    %r: %d,' % ('key%d' % i, i) for i in range(count)])
+    lines.append('}')
+    lines.append('L = [')
+    lines.extend(['    %r,' % ('item%d' % i) for i in range(count)])
+    lines.append(']')
+    lines.append('T = (' + ', '.join([repr(i * 0.5) for i in range(count)]) + ')')
+    return '\n'.join(lines) + '\n'
+
+def _stress_classes(count=4, methods=30):
+    """classes with many methods and nested classes"""
+    lines = []
+    for n in range(count):
+        lines.append('class C%d(object):' % n)
+        lines.append('    """class %d"""' % n)
+        lines.append('    class Inner:')
+        lines.append('        __slots__ = ("a", "b")')
+        for i in range(methods):
+            lines.append('    def m%d(self, x):' % i)
+            lines.append('        self.__p%d = [y for y in x if y != %d]' % (i, i))
+            lines.append('        return self.__p%d' % i)
+        lines.append('    @property')
+        lines.append('    def p(self):')
+        lines.append('        return self.m0(())')
+    return '\n'.join(lines) + '\n'
+
+# the synthetic modules of the corpus, in order
+STRESS = [
+    ('stress_functions', _stress_functions),
+    ('stress_nesting', _stress_nesting),
+    ('stress_expressions', _stress_expressions),
+    ('stress_literals', _stress_literals),
+    ('stress_classes', _stress_classes),
+]
+
+def build_corpus(corpus_dir, srcdir=None, count=None):
+    """
+    Compile the corpus into .pyc files in 'corpus_dir', return their
+    names.  The first 'count' modules of 'srcdir' (all if None) are
+    taken; sources which don't compile with the running Python are left
+    out.
+    """
+    if srcdir is None:
+        srcdir = os.path.dirname(os.__file__)
+    sources = []
+    for filename in sorted(glob.glob(os.path.join(srcdir, '*.py')))[:count]:
+        fp = open(filename, 'rU')
+        sources.append((os.path.basename(filename)[:-3], fp.read()))
+        fp.close()
+    for name, generate in STRESS:
+        sources.append((name, generate()))
+    if not os.path.isdir(corpus_dir):
+        os.makedirs(corpus_dir)
+    magic = imp.get_magic()
+    files = []
+    for name, source in sources:
+        try:
+            co = compile(source + '\n', name + '.py', 'exec')
+        except SyntaxError:
+            continue
+        filename = os.path.join(corpus_dir, name + '.pyc')
+        fp = open(filename, 'wb')
+        fp.write(magic + '\0\0\0\0' + marshal.dumps(co))
+        fp.close()
+        files.append(filename)
+    return files
+
+def corpus_digest(files):
+    """Return the SHA-1 hex digest of the names and contents of 'files'."""
+    h = hashlib.sha1()
+    for filename in files:
+        fp = open(filename, 'rb')
+        data = fp.read()
+        fp.close()
+        h.update('%s %d\n' % (os.path.basename(filename), len(data)))
+        h.update(data)
+    return h.hexdigest()
+
+def _bench_file(filename, repeat, do_verify):
+    """Return the record of the fastest of 'repeat' runs over 'filename'."""
+    rec = {'file': os.path.basename(filename),
+           'bytes': os.path.getsize(filename), 'status': 'ok'}
+    best = {}
+    for i in range(repeat):
+        stats = {}
+        t = time.time()
+        version, co = uncompyle2._load_module(filename)
+        stats['load'] = time.time() - t
+        out = StringIO()
+        try:
+            uncompyle2.uncompyle(version, co, out, stats=stats)
+        except Exception, e:
+            rec['status'] = 'failed'
+            rec['error'] = type(e).__name__
+            return rec
+        if do_verify:
+            t = time.time()
+            try:
+                src_co = uncompyle2._load_file(rec['file'], out.getvalue())
+                verify.cmp_code_objects(version, co, src_co)
+            except Exception:
+                rec['status'] = 'unverified'
+            stats['verify'] = time.time() - t
+        for key, value in stats.items():
+            best[key] = min(best.get(key, value), value)
+    for key, value in best.items():
+        if isinstance(value, float):
+            value = round(value, 6)
+        rec[key] = value
+    return rec
+
+def _rate(amount, seconds):
+    if not seconds:
+        return None
+    return round(amount / seconds, 3)
+
+def run(files, repeat=3, do_verify=1, log=None):
+    """
+    Benchmark the byte-code 'files', return the results.  With 'log' (a
+    stream), a line is written per file.
+    """
+    cache_size = Walker.body_cache.maxsize
+    Walker.body_cache.maxsize = 0 # every run does the whole work
+    Walker.body_cache.clear()
+    try:
+        warm_up() # don't charge building the parser to the first file
+        base_rss = progress.peak_rss()
+        records = []
+        for filename in files:
+            rec = _bench_file(filename, repeat, do_verify)
+            records.append(rec)
+            if log is not None:
+                print >>log, '%-11s %8.3fs %s' % (rec['status'],
+                    sum([rec.get(stage, 0) for stage in STAGES]), rec['file'])
+    finally:
+        Walker.body_cache.maxsize = cache_size
+    done = [rec for rec in records if rec['status'] != 'failed']
+    stages = {}
+    for stage in STAGES:
+        stages[stage] = round(sum([rec.get(stage, 0) for rec in done]), 6)
+    stages['total'] = round(sum([stages[stage] for stage in STAGES]), 6)
+    tot_bytes = sum([rec['bytes'] for rec in done])
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'corpus': {'files': len(files),
+                   'bytes': sum([os.path.getsize(f) for f in files]),
+                   'digest': corpus_digest(files)},
+        'repeat': repeat,
+        'verify': bool(do_verify),
+        'stages': stages,
+        'throughput': {
+            'files': _rate(len(done), stages['total']),
+            'bytes': _rate(tot_bytes, stages['total']),
+            'tokens': _rate(sum([rec.get('tokens', 0) for rec in done]),
+                            stages['scan']),
+            'nodes': _rate(sum([rec.get('nodes', 0) for rec in done]),
+                           stages['parse']),
+        },
+        'base_rss': base_rss,
+        'peak_rss': progress.peak_rss(),
+        'failed': [rec['file'] for rec in records if rec['status'] == 'failed'],
+        'unverified': [rec['file'] for rec in records
+                       if rec['status'] == 'unverified'],
+        'files': records,
+    }
+
+def compare(results, baseline, thresholds=None):
+    """
+    Return the regressions of 'results' against 'baseline' as a list of
+    (name, old, new): the stage totals and the peak RSS which grew by
+    more than their fraction in 'thresholds' (THRESHOLDS by default),
+    and 'failed' or 'unverified' with the numbers of such files if any
+    file newly is.  Raises ValueError if the corpora differ.
+    """
+    if results['corpus']['digest'] != baseline['corpus']['digest']:
+        raise ValueError('the baseline was measured on another corpus')
+    limits = dict(THRESHOLDS)
+    limits.update(thresholds or {})
+    regressions = []
+    for name in STAGES + ('total',):
+        old = baseline['stages'].get(name)
+        new = results['stages'].get(name)
+        if old and new is not None and new > old * (1 + limits[name]):
+            regressions.append((name, old, new))
+    old, new = baseline.get('peak_rss'), results.get('peak_rss')
+    if old and new is not None and new > old * (1 + limits['peak_rss']):
+        regressions.append(('peak_rss', old, new))
+    for name in ('failed', 'unverified'):
+        old, new = baseline.get(name, []), results.get(name, [])
+        if set(new) - set(old):
+            regressions.append((name, len(old), len(new)))
+    return regressions
+
+def parse_thresholds(specs):
+    """Return the thresholds of '[stage=]fraction' specs; no stage means all."""
+    thresholds = {}
+    for spec in specs:
+        name, sep, value = spec.rpartition('=')
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValueError('bad threshold %r, expected [stage=]fraction' % spec)
+        if not sep:
+            thresholds.update(dict.fromkeys(THRESHOLDS, value))
+        elif name in THRESHOLDS:
+            thresholds[name] = value
+        else:
+            raise ValueError('unknown stage %r in threshold %r' % (name, spec))
+    return thresholds
+
+def _print_results(results, out=sys.stdout):
+    corpus = results['corpus']
+    print >>out, '# %d files, %d bytes, best of %d, Python %s' % \
+          (corpus['files'], corpus['bytes'], results['repeat'],
+           results['python'])
+    for stage in STAGES + ('total',):
+        print >>out, '%-8s %10.3fs' % (stage, results['stages'][stage])
+    rates = results['throughput']
+    for name in ('files', 'bytes', 'tokens', 'nodes'):
+        if rates[name] is not None:
+            print >>out, '%-8s %10.1f/s' % (name, rates[name])
+    print >>out, 'peak RSS %10.1f MB' % (results['peak_rss'] / 1048576.0)
+    if results['failed'] or results['unverified']:
+        print >>out, '# %d failed, %d unverified' % \
+              (len(results['failed']), len(results['unverified']))
+
+if __name__ == '__main__':
+    import getopt
+    usage = 'Usage: benchmark.py [-s srcdir] [-n count] [-r repeat] ' \
+            '[-c corpus-dir] [-V] [-o results.json] [-b baseline.json] ' \
+            '[-t [stage=]fraction ...]'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 's:n:r:c:Vo:b:t:')
+        options = dict(opts)
+        thresholds = parse_thresholds([val for opt, val in opts if opt == '-t'])
+        count = options.get('-n') and int(options['-n'])
+        repeat = int(options.get('-r', 3))
+    except (getopt.GetoptError, ValueError), e:
+        print >>sys.stderr, e
+        print >>sys.stderr, usage
+        sys.exit(2)
+    if args:
+        print >>sys.stderr, usage
+        sys.exit(2)
+    corpus_dir = options.get('-c') or tempfile.mkdtemp(prefix='uncompyle-bench-')
+    try:
+        files = build_corpus(corpus_dir, options.get('-s'), count)
+        results = run(files, repeat, '-V' not in options, log=sys.stderr)
+    finally:
+        if '-c' not in options:
+            shutil.rmtree(corpus_dir, True)
+    _print_results(results)
+    if '-o' in options:
+        fp = open(options['-o'], 'w')
+        json.dump(results, fp, indent=1, sort_keys=True)
+        fp.close()
+    if '-b' in options:
+        fp = open(options['-b'])
+        baseline = json.load(fp)
+        fp.close()
+        try:
+            regressions = compare(results, baseline, thresholds)
+        except ValueError, e:
+            print >>sys.stderr, e
+            sys.exit(2)
+        for name, old, new in regressions:
+            print '### regression %-10s %12.3f -> %12.3f (%+.1f%%)' % \
+                  (name, old, new, old and 100.0 * (new - old) / old or 0)
+        if regressions:
+            sys.exit(1)
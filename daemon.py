@@ -0,0 +1,219 @@
+#
+# long-lived decompile server on a local Unix socket
+#
+# A fresh process pays for building the grammar (Parser.p collects every
+# p_* docstring) and for growing the Earley state machine state by state
+# while the first files are parsed.  The daemon pays that once: it warms
+# the parser up and then serves requests from the same process.
+#
+# Protocol: one JSON object per line in each direction; a connection may
+# carry any number of requests.  A request is
+#
+#	{"path": "/some/file.pyc"}		a byte-code file
+#	{"path": "lib.egg", "member": "m.pyc"}	a member of a zip archive
+#	{"data": "<base64>"}			the contents of a .pyc file
+#
+# optionally with "deob": 1.  The response is
+#
+#	{"status": "ok", "source": "...", "time": 0.004}
+#	{"status": "failed", "source": "<partial output>", "time": 0.01,
+#	 "error": {"type": "ParserError", "message": "...", "offset": "12"}}
+#	{"status": "timeout", "source": "", "time": 60.02,
+#	 "error": {"type": "WorkerKilled", "message": "timeout"}}
+#
+# With a time limit (-t seconds, DEFAULT_TIMEOUT unless 0) or a memory
+# limit (-m megabytes), each request is decompiled in a supervised
+# child process forked from the warm daemon (see supervisor.imap()),
+# which is killed when it exceeds them; the status is then 'timeout'
+# or 'oom'.  Without limits the daemon decompiles by itself, and a
+# pathological file holds it up.
+#
+# Usage: python daemon.py [-t seconds] [-m megabytes] [-w file.pyc ...]
+#			  socket-path
+#
+
+import os, sys, time, json, base64, SocketServer
+from cStringIO import StringIO
+
+import uncompyle2
+from uncompyle2 import archive
+
+__all__ = ['DecompileServer', 'serve', 'request', 'warm_up']
+
+# seconds a request may take
+DEFAULT_TIMEOUT = 60
+
+# exercises most of the grammar, so that the parser's state machine is
+# built before the first request comes in
+WARM_UP_SOURCE = '''
+import os, sys as system
+from os.path import join as j, split
+__all__ = ['f', 'C']
+def f(a, b=1, *args, **kw):
+    """doc"""
+    global g
+    x = [i * 2 for i in args if i]
+    y = dict((k, v) for k, v in kw.items())
+    z = {k: v for k, v in kw.items()}
+    s = {i for i in x}
+    for i in x:
+        if i > 1 and b or not a:
+            continue
+        elif i:
+            break
+    else:
+        pass
+    while a:
+        a -= 1
+    try:
+        print >>system.stderr, a[1:2], a[::2], -b, ~b
+    except (IOError, OSError), e:
+        raise
+    except:
+        pass
+    else:
+        del x[0]
+    finally:
+        g = lambda q, r=2: q if r else (q, r)
+    with open(j('a', 'b')) as fp:
+        fp.read()
+    assert a, 'message'
+    exec 'pass' in kw
+    return f(*args, **kw)
+
+def gen(n):
+    while n:
+        n = yield n
+
+class C(object):
+    """doc"""
+    attr = 1
+    def __init__(self, x):
+        super(C, self).__init__()
+        self.x, self.y = x
+    @property
+    def p(self):
+        return self.x is not None
+'''
+
+def warm_up(files=()):
+    """Decompile WARM_UP_SOURCE and the byte-code 'files', discard the output."""
+    co = compile(WARM_UP_SOURCE, '<warm-up>', 'exec')
+    uncompyle2.uncompyle('2.7', co, StringIO())
+    for file in files:
+        try:
+            uncompyle2.uncompyle_file(file, StringIO())
+        except Exception:
+            pass
+
+def handle(req, timeout=None, maxrss=None):
+    """
+    Decompile what 'req' asks for, return the response.  With a timeout
+    (seconds) or maxrss (megabytes) it is done in a supervised process.
+    """
+    try:
+        if 'data' in req:
+            data = base64.b64decode(req['data'])
+        elif req.get('member'):
+            data = archive.read_member(req['path'], req['member'])
+        else:
+            fp = open(req['path'], 'rb')
+            data = fp.read()
+            fp.close()
+    except Exception, e:
+        return {'status': 'failed', 'source': '', 'time': 0.0,
+                'error': uncompyle2._error_info(e)}
+    deob = req.get('deob', 0)
+    if timeout or maxrss:
+        t = time.time()
+        for index, resp in uncompyle2.decompile_iter([data], 1, deob=deob,
+                                                     timeout=timeout,
+                                                     maxrss=maxrss):
+            pass
+        if resp['time'] is None: # killed
+            resp['time'] = time.time() - t
+    else:
+        resp = uncompyle2.decompile(data, deob=deob)
+    if resp['error'] is None:
+        del resp['error']
+    return resp
+
+class DecompileHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while 1:
+            line = self.rfile.readline()
+            if not line:
+                break
+            try:
+                req = json.loads(line)
+            except ValueError, e:
+                resp = {'status': 'failed',
+                        'error': {'type': 'ValueError',
+                                  'message': 'bad request: %s' % e}}
+            else:
+                resp = handle(req, self.server.timeout, self.server.maxrss)
+            self.wfile.write(json.dumps(resp) + '\n')
+            self.wfile.flush()
+
+class DecompileServer(SocketServer.UnixStreamServer):
+    """
+    Requests are served one at a time: the parser is shared state, and
+    keeping it in one process is the point of the daemon.  'timeout' and
+    'maxrss' limit each request, see handle().
+    """
+    def __init__(self, path, timeout=DEFAULT_TIMEOUT, maxrss=None):
+        if os.path.exists(path):
+            os.remove(path) # stale socket of a previous daemon
+        self.timeout = timeout
+        self.maxrss = maxrss
+        SocketServer.UnixStreamServer.__init__(self, path, DecompileHandler)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+def serve(path, warm_files=(), timeout=DEFAULT_TIMEOUT, maxrss=None):
+    import signal
+    # let a plain kill remove the socket file, too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    warm_up(warm_files)
+    server = DecompileServer(path, timeout, maxrss)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def request(path, req):
+    """Send a single request to the daemon at socket 'path', return the response."""
+    import socket
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        fp = s.makefile('rb+')
+        fp.write(json.dumps(req) + '\n')
+        fp.flush()
+        resp = json.loads(fp.readline())
+        fp.close()
+    finally:
+        s.close()
+    return resp
+
+if __name__ == '__main__':
+    import getopt
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'w:t:m:')
+    except getopt.GetoptError, e:
+        print >>sys.stderr, e
+        args = []
+    if len(args) != 1:
+        print >>sys.stderr, 'Usage: daemon.py [-t seconds] [-m megabytes] ' \
+              '[-w file.pyc ...] socket-path'
+        sys.exit(1)
+    timeout, maxrss = DEFAULT_TIMEOUT, None
+    for opt, val in opts:
+        if opt == '-t':
+            timeout = float(val) or None
+        elif opt == '-m':
+            maxrss = int(val)
+    serve(args[0], [val for opt, val in opts if opt == '-w'], timeout, maxrss)
@@ -0,0 +1,63 @@
+#
+# callbacks at the start and end of each stage of the decompiler
+#
+# A hook is a callable hook(event, stage, info), registered with
+# register().  'event' is 'start' or 'end', 'stage' one of STAGES, and
+# 'info' a dict with
+#
+#	name	name of the code object (of the file for 'load'), or None
+#	size	size of the input of the stage: bytes of the file for
+#		'load', of the byte-code for 'disassemble',
+#		'find_jump_targets' and 'verify', tokens for 'parse' and
+#		AST nodes for 'gen_source'
+#	time	seconds the stage took ('end' only)
+#	error	the exception which ended the stage, or None ('end' only)
+#
+# The same dict is passed at the start and at the end of a stage, so a
+# hook may keep its own items there.  Stages nest: the functions and
+# classes of a module are disassembled, parsed and generated while the
+# source of the module is generated, and 'verify' disassembles the code
+# objects it compares.  Walker.body_cache is not used while hooks are
+# registered, so every function and class goes through its stages.
+#
+# Hooks run in the process which decompiles; the
+# worker processes of main() inherit the hooks registered before it is
+# called.
+#
+# Without hooks, a stage costs a test of 'callbacks' and at most one
+# function call more.
+#
+
+import sys, time
+
+__all__ = ['STAGES', 'register', 'unregister', 'call']
+
+STAGES = ('load', 'disassemble', 'find_jump_targets', 'parse', 'gen_source',
+          'verify')
+
+# the registered hooks; empty if none
+callbacks = []
+
+def register(hook):
+    """Call 'hook' at the start and end of each stage from now on."""
+    callbacks.append(hook)
+
+def unregister(hook):
+    callbacks.remove(hook)
+
+def call(stage, name, size, func, *args, **kw):
+    """Return func(*args, **kw), run as stage 'stage' of code object 'name'."""
+    info = {'name': name, 'size': size}
+    for hook in callbacks[:]:
+        hook('start', stage, info)
+    info['error'] = None
+    t = time.time()
+    try:
+        return func(*args, **kw)
+    except BaseException:
+        info['error'] = sys.exc_info()[1]
+        raise
+    finally:
+        info['time'] = time.time() - t
+        for hook in callbacks[:]:
+            hook('end', stage, info)
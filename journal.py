@@ -0,0 +1,118 @@
+#
+# checkpoint journal of main(), for resuming a run which died
+#
+# While main(checkpoint=1) writes below out_base, every finished input
+# is appended to a journal next to it, and the line is flushed right
+# away:
+#
+#	# uncompyle2 journal <tag>
+#	<status> <sha1 of the output file> <file>
+#
+# A run which dies (OOM killer, reboot) leaves the journal behind; one
+# which completes removes it.  main(resume=1) then skips the inputs in
+# the journal whose output is still there.  The entries written last
+# may belong to output files the kernel never wrote out before a
+# reboot, so the output of the last RECHECK entries is hashed again,
+# and the input is decompiled anew if it differs.  A journal of a run
+# with other options (see manifest.py for the tag) is ignored.
+#
+
+import os, hashlib
+
+__all__ = ['Journal', 'journal_name', 'output_digest']
+
+HEADER = '# uncompyle2 journal '
+
+# number of entries at the end of a journal whose output is checked
+RECHECK = 64
+
+def journal_name(out_base):
+    """Return the name of the journal kept next to 'out_base'."""
+    return os.path.normpath(out_base) + '.journal'
+
+def output_digest(filename):
+    """Return the SHA-1 hex digest of output file 'filename', None if missing."""
+    h = hashlib.sha1()
+    try:
+        fp = open(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        while 1:
+            data = fp.read(65536)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        fp.close()
+    return h.hexdigest()
+
+class Journal:
+    """
+    Open journal 'filename' for appending.  With 'resume', the entries
+    of an existing journal with the same tag are kept, otherwise it is
+    started afresh.
+    """
+    def __init__(self, filename, tag, resume=False):
+        self.filename = filename
+        self.tag = tag
+        self.entries = {}
+        self.recheck = set()
+        if resume:
+            self.load()
+        try:
+            os.makedirs(os.path.dirname(filename))
+        except OSError:
+            pass
+        if self.entries:
+            self.fp = open(filename, 'rb+')
+            self.fp.seek(-1, 2)
+            if self.fp.read(1) != '\n':
+                self.fp.write('\n') # end a line cut off by the crash
+            self.fp.seek(0, 2)
+        else:
+            self.fp = open(filename, 'w')
+            self.fp.write(HEADER + tag + '\n')
+            self.fp.flush()
+
+    def load(self):
+        try:
+            fp = open(self.filename, 'r')
+        except IOError:
+            return
+        try:
+            if fp.readline().rstrip('\n') != HEADER + self.tag:
+                return # other version or options: start afresh
+            order = []
+            for line in fp:
+                if not line.endswith('\n'):
+                    break # cut off
+                try:
+                    status, digest, file = line.rstrip('\n').split(' ', 2)
+                except ValueError:
+                    continue
+                self.entries[file] = (status, digest)
+                order.append(file)
+            self.recheck = set(order[-RECHECK:])
+        finally:
+            fp.close()
+
+    def get(self, file):
+        """
+        Return (status, digest, recheck) recorded for 'file' or None;
+        recheck is true if the digest of its output must be checked.
+        """
+        entry = self.entries.get(file)
+        if entry is None:
+            return None
+        return entry + (file in self.recheck,)
+
+    def add(self, file, status, digest):
+        self.fp.write('%s %s %s\n' % (status, digest or '-', file))
+        self.fp.flush()
+
+    def close(self, remove=False):
+        """Close the journal; with 'remove', the run is complete."""
+        self.fp.close()
+        if remove:
+            os.remove(self.filename)
@@ -0,0 +1,102 @@
+#
+# manifest of decompiled files, used for incremental runs of main()
+#
+# The manifest is a text file next to the output directory.  The first
+# line identifies the decompiler version and the options of the run
+# which wrote it; every other line holds the content hash, status and
+# name of one input file:
+#
+#	# uncompyle2 manifest <tag>
+#	<sha1> <status> <file>
+#
+# A manifest written with a different tag is ignored as a whole.
+# Sharded runs write one manifest per shard (see shards.py).
+#
+
+import os, hashlib
+import archive
+
+__all__ = ['Manifest', 'file_digest', 'manifest_name', 'read_tag']
+
+HEADER = '# uncompyle2 manifest '
+
+def manifest_name(out_base):
+    """Return the name of the manifest kept next to 'out_base'."""
+    return os.path.normpath(out_base) + '.manifest'
+
+def read_tag(filename):
+    """Return the tag of manifest 'filename' or None if it is none."""
+    fp = open(filename, 'r')
+    try:
+        line = fp.readline().rstrip('\n')
+    finally:
+        fp.close()
+    if line.startswith(HEADER):
+        return line[len(HEADER):]
+    return None
+
+def file_digest(filename, member=None):
+    """
+    Return the SHA-1 hex digest of the contents of 'filename' or of
+    its member 'member' if it is a zip archive.
+    """
+    if member is not None:
+        return hashlib.sha1(archive.read_member(filename, member)).hexdigest()
+    h = hashlib.sha1()
+    fp = open(filename, 'rb')
+    try:
+        while 1:
+            data = fp.read(65536)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        fp.close()
+    return h.hexdigest()
+
+class Manifest:
+    def __init__(self, filename, tag):
+        self.filename = filename
+        self.tag = tag
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        try:
+            fp = open(self.filename, 'r')
+        except IOError:
+            return
+        try:
+            if fp.readline().rstrip('\n') != HEADER + self.tag:
+                return # other version or options: start afresh
+            for line in fp:
+                digest, status, file = line.rstrip('\n').split(' ', 2)
+                self.entries[file] = (digest, status)
+        finally:
+            fp.close()
+
+    def get(self, file):
+        """Return (digest, status) recorded for 'file' or None."""
+        return self.entries.get(file)
+
+    def update(self, file, digest, status):
+        self.entries[file] = (digest, status)
+
+    def save(self):
+        """Write the manifest, replacing the old one atomically."""
+        tmpname = self.filename + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.filename))
+        except OSError:
+            pass
+        fp = open(tmpname, 'w')
+        try:
+            fp.write(HEADER + self.tag + '\n')
+            for file in sorted(self.entries):
+                digest, status = self.entries[file]
+                fp.write('%s %s %s\n' % (digest, status, file))
+        finally:
+            fp.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename) # rename() does not replace on win32
+        os.rename(tmpname, self.filename)
@@ -0,0 +1,90 @@
+#
+# cProfile profiles of the decompiler, one per stage
+#
+# uncompyle(profile=StageProfiler()) records the 'scan', 'parse' and
+# 'emit' stages into separate profiles.  The scanning and parsing of
+# nested code objects, which happens while the module is emitted, is
+# charged to 'scan' and 'parse', so 'emit' shows the Walker alone.
+#
+# main(profile=dir) writes the profiles of a file to
+#
+#	<dir>/<file>.<stage>.prof
+#
+# and those of all files profiled by the run to <dir>/all.<stage>.prof.
+# They can be read with pstats, or printed:
+#
+#	python profiling.py [-n count] [-s sort-key] dump ...
+#
+
+import os, sys, cProfile, pstats
+
+__all__ = ['StageProfiler', 'aggregate']
+
+class StageProfiler:
+    """
+    enter() starts recording into the profile of a stage, leave()
+    returns to the stage entered before.
+    """
+    def __init__(self):
+        self.profiles = {}
+        self.stack = []
+
+    def enter(self, stage):
+        if self.stack:
+            self.profiles[self.stack[-1]].disable()
+        profile = self.profiles.get(stage)
+        if profile is None:
+            profile = self.profiles[stage] = cProfile.Profile()
+        self.stack.append(stage)
+        profile.enable()
+
+    def leave(self):
+        self.profiles[self.stack.pop()].disable()
+        if self.stack:
+            self.profiles[self.stack[-1]].enable()
+
+    def dump(self, prefix):
+        """
+        Write the profile of each stage to <prefix>.<stage>.prof, return
+        a dict of the file names by stage.
+        """
+        try:
+            os.makedirs(os.path.dirname(prefix))
+        except OSError:
+            pass
+        dumps = {}
+        for stage, profile in self.profiles.items():
+            dumps[stage] = '%s.%s.prof' % (prefix, stage)
+            profile.dump_stats(dumps[stage])
+        return dumps
+
+def aggregate(dumps, prefix):
+    """
+    Add up the profiles in 'dumps', a sequence of dicts as returned by
+    StageProfiler.dump(), into <prefix>.<stage>.prof per stage.  Return
+    a dict of the file names by stage.
+    """
+    by_stage = {}
+    for files in dumps:
+        for stage, filename in files.items():
+            by_stage.setdefault(stage, []).append(filename)
+    result = {}
+    for stage, filenames in by_stage.items():
+        result[stage] = '%s.%s.prof' % (prefix, stage)
+        pstats.Stats(*filenames).dump_stats(result[stage])
+    return result
+
+if __name__ == '__main__':
+    import getopt
+    usage = 'Usage: profiling.py [-n count] [-s sort-key] dump ...'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'n:s:')
+    except getopt.GetoptError, e:
+        print >>sys.stderr, e
+        args = []
+    if not args:
+        print >>sys.stderr, usage
+        sys.exit(1)
+    opts = dict(opts)
+    stats = pstats.Stats(*args)
+    stats.sort_stats(opts.get('-s', 'cumulative')).print_stats(int(opts.get('-n', 30)))
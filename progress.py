@@ -0,0 +1,131 @@
+#
+# progress reports for long batch runs of main()
+#
+# A report gives the number of files done, files and input bytes per
+# second, the failure rate, the peak RSS of all processes and an ETA.
+# It is either a human readable line or a JSON object per line.
+#
+
+import sys, time
+
+try:
+    import resource
+except ImportError: # not on win32
+    resource = None
+
+__all__ = ['Progress', 'peak_rss']
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes (0 if unknown)."""
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss # bytes already
+    return rss * 1024
+
+def _fmt_time(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds / 3600, seconds / 60 % 60, seconds % 60)
+
+class Progress:
+    """
+    Collect the results of main()'s jobs and report every 'interval'
+    seconds to 'out'.
+
+    total	number of inputs, if known; needed for the ETA
+    format	'text' or 'json'
+    """
+    def __init__(self, total=None, out=None, interval=2.0, format='text'):
+        self.total = total
+        self.out = out or sys.stderr
+        self.interval = interval
+        self.format = format
+        self.start = self.last = time.time()
+        self.done = 0.0 # inputs done; archive members count fractionally
+        self.files = 0
+        self.bytes = 0
+        self.failed = 0
+        self.unverified = 0
+        self.skipped = 0
+        self.peak_rss = peak_rss()
+        self.tty = hasattr(self.out, 'isatty') and self.out.isatty()
+
+    def update(self, result):
+        self.done += result.get('weight', 1.0)
+        self.files += 1
+        self.bytes += result.get('insize') or 0
+        status = result['status']
+        if status == 'unverified':
+            self.unverified += 1
+        elif status != 'ok':
+            self.failed += 1
+        if result.get('skipped'):
+            self.skipped += 1
+        self.peak_rss = max(self.peak_rss, result.get('maxrss') or 0)
+        self.tick()
+
+    def tick(self):
+        """Report if 'interval' seconds have passed since the last report."""
+        now = time.time()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report()
+
+    def stats(self):
+        """Return the current figures as a dict."""
+        elapsed = time.time() - self.start
+        stats = {
+            'elapsed': round(elapsed, 3),
+            'files': self.files,
+            'bytes': self.bytes,
+            'failed': self.failed,
+            'unverified': self.unverified,
+            'skipped': self.skipped,
+            'files_per_sec': 0.0,
+            'bytes_per_sec': 0.0,
+            'failure_rate': 0.0,
+            'peak_rss': self.peak_rss,
+            'total': self.total,
+            'eta': None,
+            }
+        if elapsed > 0:
+            stats['files_per_sec'] = round(self.files / elapsed, 2)
+            stats['bytes_per_sec'] = round(self.bytes / elapsed, 1)
+        if self.files:
+            stats['failure_rate'] = round(float(self.failed) / self.files, 4)
+        if self.total and self.done:
+            stats['eta'] = round(elapsed / self.done * (self.total - self.done), 1)
+        return stats
+
+    def report(self, final=False):
+        stats = self.stats()
+        if self.format == 'json':
+            import json
+            stats['final'] = final
+            self.out.write(json.dumps(stats, sort_keys=True) + '\n')
+            self.out.flush()
+            return
+
+        if self.total:
+            line = '[%d/%d %5.1f%%]' % (self.done, self.total,
+                                        100.0 * self.done / self.total)
+        else:
+            line = '[%d]' % self.files
+        line += ' %d files %.1f files/s %.1f kB/s failed %d (%.1f%%)' % (
+            self.files, stats['files_per_sec'], stats['bytes_per_sec'] / 1024,
+            self.failed, 100 * stats['failure_rate'])
+        if self.unverified:
+            line += ' unverified %d' % self.unverified
+        if self.peak_rss:
+            line += ' peak %d MB' % (self.peak_rss / (1024 * 1024))
+        if final:
+            line += ' in %s' % _fmt_time(stats['elapsed'])
+        elif stats['eta'] is not None:
+            line += ' ETA %s' % _fmt_time(stats['eta'])
+        if self.tty:
+            # refresh a single line
+            self.out.write('\r' + line + '\033[K' + (final and '\n' or ''))
+        else:
+            self.out.write(line + '\n')
+        self.out.flush()
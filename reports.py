@@ -0,0 +1,94 @@
+#
+# per-file run reports of main()
+#
+# A report has one JSON object per line and input file, in input order:
+#
+#	{"file": "pkg/mod.pyc", "status": "ok", "insize": 1234,
+#	 "outsize": 2345, "tokens": 456, "nodes": 789,
+#	 "time": {"load": 0.001, "scan": 0.01, "parse": 0.1, "emit": 0.02,
+#		  "verify": 0.05, "total": 0.19}}
+#
+# status is 'ok', 'failed', 'unverified', 'partial', 'timeout', 'oom' or
+# 'skipped' (unchanged in an incremental run; 'previous' then holds the
+# status of the run which decompiled it).  An input which was not decompiled
+# because it equals an earlier one (main()'s dedup) gets that input's
+# status, 'duplicate_of' names that input and there are no timings.
+# 'load' is _load_module(), 'scan' Scanner.disassemble(), 'parse'
+# Walker.build_ast(), 'emit' Walker.gen_source() without the scanning
+# and parsing of nested code objects and 'verify'
+# verify.cmp_code_objects().  Items which are not known (e.g. for a
+# killed worker) are null.
+#
+# Reports of several shards of a run are combined by shards.merge().
+#
+
+import json
+
+__all__ = ['Report', 'record', 'read', 'tally']
+
+STAGES = ('load', 'scan', 'parse', 'emit', 'verify', 'total')
+
+def record(result):
+    """Return the report record for a result of _uncompyle_job()."""
+    stats = result.get('stats') or {}
+    rec = {
+        'file': result['file'],
+        'status': result['status'],
+        'insize': result.get('insize'),
+        'outsize': result.get('outsize'),
+        'tokens': stats.get('tokens'),
+        'nodes': stats.get('nodes'),
+        'time': {},
+        }
+    for stage in STAGES:
+        t = stats.get(stage)
+        if t is not None:
+            t = round(t, 6)
+        rec['time'][stage] = t
+    if result.get('duplicate_of'):
+        rec['duplicate_of'] = result['duplicate_of']
+    if result.get('skipped'):
+        rec['status'] = 'skipped'
+        rec['previous'] = result['status']
+    return rec
+
+def read(filename):
+    """Return the records of report 'filename'."""
+    fp = open(filename, 'r')
+    try:
+        return [json.loads(line) for line in fp if line.strip()]
+    finally:
+        fp.close()
+
+def tally(records):
+    """
+    Return main()'s tallies for 'records':
+    (tot_files, okay_files, failed_files, verify_failed_files).
+    """
+    tot = okay = failed = verify_failed = 0
+    for rec in records:
+        status = rec['status']
+        if status == 'skipped':
+            status = rec['previous']
+        if status in ('failed', 'timeout', 'oom', 'partial'):
+            failed += 1
+            continue
+        tot += 1
+        if status == 'unverified':
+            verify_failed += 1
+        else:
+            okay += 1
+    return (tot, okay, failed, verify_failed)
+
+class Report:
+    def __init__(self, filename):
+        self.fp = open(filename, 'w')
+
+    def add(self, result):
+        self.write(record(result))
+
+    def write(self, rec):
+        self.fp.write(json.dumps(rec, sort_keys=True) + '\n')
+
+    def close(self):
+        self.fp.close()
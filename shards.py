@@ -0,0 +1,114 @@
+#
+# static sharding of main()'s file list across machines
+#
+# A shard spec 'i/n' (1 <= i <= n) selects the files whose path hashes
+# to shard i of n.  The partition depends on nothing but the path
+# relative to in_base, so n machines given the same file list and the
+# specs 1/n .. n/n decompile every file exactly once without talking to
+# each other.
+#
+# Each shard writes its own report (main()'s report=) and, in
+# incremental runs, its own manifest next to out_base:
+#
+#	<out_base>.manifest.<i>-of-<n>
+#
+# merge() combines the reports into the final tallies and the partial
+# manifests into <out_base>.manifest:
+#
+#	python shards.py [-o merged-report] [-m out_base] report ...
+#
+
+import os, re, sys, glob, hashlib
+import manifest, reports
+
+__all__ = ['parse_spec', 'in_shard', 'select', 'shard_name', 'merge',
+           'merge_manifests']
+
+def parse_spec(spec):
+    """Return (index, count) of a shard spec 'i/n' or an (i, n) tuple."""
+    if isinstance(spec, basestring):
+        try:
+            index, count = map(int, spec.split('/'))
+        except ValueError:
+            raise ValueError('bad shard spec %r, expected i/n' % spec)
+    else:
+        index, count = spec
+    if not 1 <= index <= count:
+        raise ValueError('bad shard spec %r, need 1 <= i <= n' % (spec,))
+    return index, count
+
+def in_shard(file, index, count):
+    """Return true if 'file' belongs to shard 'index' of 'count'."""
+    # the same on every platform: not hash(), not os.sep
+    key = file.replace(os.sep, '/')
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:8], 16) % count == index - 1
+
+def select(files, spec):
+    """Return the files of 'files' which belong to shard 'spec'."""
+    index, count = parse_spec(spec)
+    return [file for file in files if in_shard(file, index, count)]
+
+def shard_name(filename, spec):
+    """Return the name of the partial file of shard 'spec' for 'filename'."""
+    return '%s.%d-of-%d' % ((filename,) + parse_spec(spec))
+
+def merge_manifests(out_base):
+    """
+    Merge the partial manifests of all shards of 'out_base' into its
+    manifest.  Entries of the shards replace those of an older merged
+    manifest.  Return the number of entries.
+    """
+    target = manifest.manifest_name(out_base)
+    # not the .tmp files an interrupted Manifest.save() leaves behind
+    parts = sorted(part for part in glob.glob(target + '.*-of-*')
+                   if re.search(r'\.\d+-of-\d+$', part))
+    if not parts:
+        return 0
+    tag = manifest.read_tag(parts[0])
+    merged = manifest.Manifest(target, tag)
+    for part in parts:
+        if manifest.read_tag(part) != tag:
+            raise ValueError('%s was written by a run with other options' % part)
+        merged.entries.update(manifest.Manifest(part, tag).entries)
+    merged.save()
+    return len(merged.entries)
+
+def merge(report_files, outfile=None, out_base=None):
+    """
+    Combine the reports of all shards, optionally into the report
+    'outfile', and with out_base the partial manifests.  Return the
+    tallies main() would have returned for the whole file list:
+    (tot_files, okay_files, failed_files, verify_failed_files).
+    """
+    records = []
+    for filename in report_files:
+        records.extend(reports.read(filename))
+    records.sort(key=lambda rec: rec['file'])
+    if outfile:
+        rp = reports.Report(outfile)
+        try:
+            for rec in records:
+                rp.write(rec)
+        finally:
+            rp.close()
+    if out_base:
+        merge_manifests(out_base)
+    return reports.tally(records)
+
+if __name__ == '__main__':
+    import getopt
+    usage = 'Usage: shards.py [-o merged-report] [-m out_base] report ...'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'o:m:')
+    except getopt.GetoptError, e:
+        print >>sys.stderr, e
+        args = []
+    if not args:
+        print >>sys.stderr, usage
+        sys.exit(1)
+    opts = dict(opts)
+    tot, okay, failed, verify_failed = merge(args, opts.get('-o'), opts.get('-m'))
+    print '# decompiled %i files: %i okay, %i failed, %i verify failed' % \
+          (tot, okay, failed, verify_failed)
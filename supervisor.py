@@ -0,0 +1,195 @@
+#
+# supervised worker processes with per-item time and memory limits
+#
+# multiprocessing.Pool can not take back a task once it is running, so a
+# single pathological input would stall a whole batch.  Here every worker
+# is a process of its own which is killed and replaced as soon as the
+# item it is working on exceeds its time budget or memory cap.
+#
+
+import os, time, signal, select, multiprocessing
+try:
+    import resource
+except ImportError: # not on win32
+    resource = None
+
+__all__ = ['imap', 'WorkerKilled']
+
+TICK = 0.05 # seconds between two checks of the limits
+
+class WorkerKilled(Exception):
+    """Raised for an item whose worker was killed and no handler given."""
+    def __init__(self, item, reason):
+        self.item = item
+        self.reason = reason
+
+    def __str__(self):
+        return 'worker killed (%s) on %r' % (self.reason, self.item)
+
+if os.path.exists('/proc/self/statm'):
+    _PAGESIZE = os.sysconf('SC_PAGE_SIZE')
+    def _rss(pid):
+        """Return the resident set size of process 'pid' in bytes."""
+        try:
+            mi = open('/proc/%d/statm' % pid, 'r')
+            try:
+                return int(mi.readline().split()[1]) * _PAGESIZE
+            finally:
+                mi.close()
+        except (IOError, OSError):
+            return 0
+else:
+    _rss = None
+
+def _serve(conn, func, maxrss):
+    # Ctrl-C is handled by the supervisor, which kills us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if maxrss and _rss is None and resource:
+        # can't watch the RSS from outside: limit the address space
+        try:
+            resource.setrlimit(resource.RLIMIT_AS, (maxrss, maxrss))
+        except (ValueError, resource.error):
+            pass
+    while 1:
+        try:
+            item = conn.recv()
+        except EOFError:
+            break
+        try:
+            result = (True, func(item))
+        except Exception, e:
+            result = (False, e)
+        try:
+            conn.send(result)
+        except Exception, e: # result or exception not picklable
+            conn.send((False, RuntimeError(str(e))))
+
+class _Worker:
+    def __init__(self, func, maxrss):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve,
+                                               args=(child, func, maxrss))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.index = self.item = self.started = None
+
+    def start(self, index, item):
+        self.index, self.item = index, item
+        self.started = time.time()
+        self.conn.send(item)
+
+    def done(self):
+        self.index = self.item = self.started = None
+
+    def kill(self):
+        # not SIGTERM: the worker may still have a handler of the parent
+        # for it, e.g. the daemon's, and a bare except: would survive it
+        if not hasattr(signal, 'SIGKILL'):
+            self.process.terminate()
+        elif self.process.exitcode is None:
+            try:
+                os.kill(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.process.join()
+        self.conn.close()
+
+def _wait(conns, timeout):
+    """Return the connections out of 'conns' which can be read."""
+    if os.name == 'posix':
+        return select.select(conns, [], [], timeout)[0]
+    ready = [c for c in conns if c.poll()]
+    if not ready:
+        time.sleep(timeout)
+    return ready
+
+def imap(func, iterable, workers, timeout=None, maxrss=None, killed=None,
+         ordered=True, idle=None):
+    """
+    Apply func to each item of iterable in 'workers' supervised worker
+    processes, yielding the results in input order, or as soon as they
+    are ready if not 'ordered'.
+
+    timeout	wall-clock seconds an item may take
+    maxrss	bytes of resident memory a worker may use
+    killed	killed(item, reason) returns the result for an item whose
+    		worker was killed; reason is 'timeout', 'oom' or
+    		'crash' (the worker died on its own).  Without a
+    		handler WorkerKilled is raised.
+    idle	if given, called every TICK seconds while waiting
+
+    An exception raised by func is re-raised here.
+    """
+    window = 16 * workers
+    pool = [_Worker(func, maxrss) for i in range(workers)]
+    items = enumerate(iter(iterable))
+    results = {}
+    sent = received = 0
+    exhausted = False
+    try:
+        while 1:
+            # hand out work, but don't run ahead too far of the oldest
+            # item still in progress
+            for w in pool:
+                if exhausted or sent - received >= window:
+                    break
+                if w.index is None:
+                    try:
+                        index, item = items.next()
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    w.start(index, item)
+                    sent += 1
+
+            if ordered:
+                while received in results:
+                    result = results.pop(received)
+                    received += 1
+                    yield result
+            else:
+                for index in sorted(results):
+                    result = results.pop(index)
+                    received += 1
+                    yield result
+
+            busy = [w for w in pool if w.index is not None]
+            if not busy:
+                if exhausted:
+                    break
+                continue
+
+            ready = _wait([w.conn for w in busy], TICK)
+            if idle:
+                idle()
+            now = time.time()
+            for w in busy:
+                if w.conn in ready:
+                    try:
+                        ok, value = w.conn.recv()
+                    except EOFError:
+                        reason = 'crash'
+                    else:
+                        if not ok:
+                            raise value
+                        results[w.index] = value
+                        w.done()
+                        continue
+                elif timeout and now - w.started > timeout:
+                    reason = 'timeout'
+                elif maxrss and _rss and _rss(w.process.pid) > maxrss:
+                    reason = 'oom'
+                else:
+                    continue
+                # kill the worker and take over its item
+                w.kill()
+                if reason == 'crash' and w.process.exitcode == -signal.SIGKILL:
+                    reason = 'oom' # most probably the kernel's OOM killer
+                if killed is None:
+                    raise WorkerKilled(w.item, reason)
+                results[w.index] = killed(w.item, reason)
+                pool[pool.index(w)] = _Worker(func, maxrss)
+    finally:
+        for w in pool:
+            w.kill()
@@ -0,0 +1,61 @@
+#
+# the bodies uncompyle() renders in worker processes (see _prefill())
+# must be found in the body cache by the walker of the module
+#
+# Run with the package importable as uncompyle2, like benchmark.py:
+#
+#	python -m unittest discover -s tests
+#
+
+import unittest
+from cStringIO import StringIO
+
+import uncompyle2
+from uncompyle2 import Walker
+
+# bump() declares 'counter' global, which takes it out of the walker's
+# mod_globs for the functions after it
+SOURCE = '''
+counter = 0
+
+def bump():
+    global counter
+    counter += 1
+
+def f1(a):
+    return a + 1
+
+def f2(a, b):
+    return a * b
+
+def f3(a):
+    return len(a)
+
+def f4(a):
+    return [x for x in a]
+
+def f5(a):
+    return counter + a
+'''
+
+def decompile(co, workers):
+    Walker.body_cache.clear()
+    Walker.body_cache.hits = Walker.body_cache.misses = 0
+    out = StringIO()
+    uncompyle2.uncompyle('2.7', co, out, workers=workers)
+    return out.getvalue()
+
+class PrefillTest(unittest.TestCase):
+    def test_hits_after_global_declaration(self):
+        co = compile(SOURCE, '<prefill>', 'exec')
+        serial = decompile(co, 1)
+        parallel = decompile(co, 2)
+        self.assertEqual(parallel, serial)
+        # bump() and f1() .. f4() don't use 'counter': the same key in
+        # the workers and the walker.  f5() is rendered anew, because
+        # the workers could not know that 'counter' is declared before.
+        self.assertEqual(Walker.body_cache.hits, 5)
+        self.assertEqual(Walker.body_cache.misses, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,7 @@
 import types
 import operator
 import dis
-import uncompyle2, Scanner
+import uncompyle2, Scanner, hooks
 
 BIN_OP_FUNCS = {
 'BINARY_POWER': operator.pow,
@@ -119,6 +119,13 @@ def cmp_code_objects(version, code_obj1, code_obj2, name=''):
 
     This is the main part of this module.
     """
+    if hooks.callbacks:
+        return hooks.call('verify', code_obj1.co_name, len(code_obj1.co_code),
+                          _cmp_code_objects, version, code_obj1, code_obj2,
+                          name)
+    return _cmp_code_objects(version, code_obj1, code_obj2, name)
+
+def _cmp_code_objects(version, code_obj1, code_obj2, name=''):
     #print code_obj1, type(code_obj2)
     assert type(code_obj1) == types.CodeType
     assert type(code_obj2) == types.CodeType
@@ -291,6 +298,7 @@ def cmp_code_objects(version, code_obj1, code_obj2, name=''):
 
 class Token(Scanner.Token):
     """Token class with changed semantics for 'cmp()'."""
+    __slots__ = ()
     
     def __cmp__(self, o):
         t = self.type # shortcut